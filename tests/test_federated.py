@@ -0,0 +1,96 @@
+# test_federated.py -- de-duplication of lines across databases
+
+import numpy as np
+
+from weeds_py import cache, catfile, db, federated, line
+
+# Partition function of CO, as (temperature, partition function)
+PARTFUNC = ([9.375, 37.5, 150., 300.], [3.7, 13.9, 54.6, 108.9])
+
+
+def write_catalog(filename, n=250):
+    # Catalog file of n CO lines (see Pickett et al. 1998 for the format)
+    rows = []
+    for j in range(n):
+        rows.append("%13.4f%8.4f%8.4f%2d%10.4f%3d%7d%4d%12s%12s" % (
+            115271.2018 * (j + 1), 0.0005, -5. + j * 1e-3, 2, 3.845 * j * (j + 1) / 2,
+            2 * j + 3, -28503, 101, "%d" % (j + 1), "%d" % j))
+    with open(filename, "w") as f:
+        f.write("\n".join(rows) + "\n")
+
+
+def test_species_name():
+    assert federated.species_name("028503 CO") == "CO"
+    assert federated.species_name("028503 CO, v=0") == "CO, v=0"
+    assert federated.species_name("CO") == "CO"
+    assert federated.species_name("028503") == "028503"
+
+
+def test_merge_catalog_and_local(tmp_path):
+    catalog_file = str(tmp_path / "co.cat")
+    write_catalog(catalog_file)
+    catalog = catfile.Catfile(catalog_file, species="028503 CO", partfunc=PARTFUNC)
+    lines = catalog.search_array(0, 0)
+    assert len(lines) == 250
+
+    # The same lines in a cache filled from the CDMS, which drops the tag
+    # of the species name
+    cache_file = str(tmp_path / "lines.db")
+    linecache = cache.Cache(cache_file)
+    linecache.create(db.dbVersion)
+    cached = lines.copy()
+    cached["species"] = "CO"
+    cached["dbsource"] = "cdms"
+    linecache.add_lines_bulk(cached, update=False)
+    linecache.add_coverage("028503 CO", 0, -1, "cdms", ["CO"])
+    linecache.close()
+    local = db.Local(cache_file)
+
+    both = federated.Federated([catalog, local])
+    try:
+        found = both.search_array(0, 0, species="028503 CO")
+    finally:
+        both.close()
+        local.close()
+        catalog.close()
+    assert len(found) == 250
+    assert set(found["dbsource"].tolist()) == {"co.cat"}
+
+    # Without a species in the search, lines are matched on their name
+    # without tag
+    merged = federated.merge([lines, cached])
+    assert len(merged) == 250
+    np.testing.assert_array_equal(merged["frequency"], np.sort(lines["frequency"]))
+
+
+def test_wildcard_species_keep_their_names(tmp_path):
+    catalog_file = str(tmp_path / "co.cat")
+    write_catalog(catalog_file, n=10)
+    catalog = catfile.Catfile(catalog_file, species="028503 CO", partfunc=PARTFUNC)
+    try:
+        lines = catalog.search_array(0, 0)
+    finally:
+        catalog.close()
+
+    # Two species matched by one wildcard search, each in its own cache
+    databases = []
+    for j, species in enumerate(["CO, v=0", "CO, v=1"]):
+        cache_file = str(tmp_path / ("lines%d.db" % j))
+        linecache = cache.Cache(cache_file)
+        linecache.create(db.dbVersion)
+        cached = lines.copy()
+        cached["species"] = species
+        cached["dbsource"] = "cdms"
+        linecache.add_lines_bulk(cached, update=False)
+        linecache.close()
+        databases.append(db.Local(cache_file))
+
+    federation = federated.Federated(databases)
+    try:
+        found = federation.search_array(0, 0, species="CO, v=*")
+    finally:
+        federation.close()
+        for database in databases:
+            database.close()
+    assert len(found) == 20
+    assert set(found["species"].tolist()) == {"CO, v=0", "CO, v=1"}
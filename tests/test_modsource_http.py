@@ -0,0 +1,305 @@
+# test_modsource_http.py -- modsource against a local stand-in for the CDMS
+
+import http.server
+import os
+import socketserver
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+import pytest
+
+from weeds_py import cdms, modsource
+
+# Species served by the stand-in, with their tag
+SPECIES = {'025501 CCH, v=0': 25501, '029501 C-13-O': 29501,
+           '030502 CO-18': 30502}
+
+
+def catalog_row(freq, tag, name, i, rng):
+    # One row of the CDMS text output
+    return "%13.4f%11.4f%11.4f  %10.4f%3d%11s%12s%15s%s" % (
+        freq, 0.001, rng.uniform(-7, -3), rng.uniform(0, 300),
+        int(rng.integers(1, 40)), "%6d 1404" % tag, "u %d" % i, "l %d" % i,
+        name)
+
+
+def catalog(species, n=500, fmin=100000., fmax=110000.):
+    tag = SPECIES[species]
+    rng = np.random.default_rng(tag)
+    return [(f, catalog_row(f, tag, species[7:], i, rng))
+            for i, f in enumerate(np.sort(rng.uniform(fmin, fmax, n)))]
+
+
+CATALOGS = dict((s, catalog(s)) for s in SPECIES)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """
+    Stand-in for the CDMS search form
+
+    A POST returns a page linking to the results, which are then read
+    with a GET, as on the CDMS. The partition function table is served
+    at /partfunc. Each request waits for latency seconds.
+
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body):
+        body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def wait(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        time.sleep(server.latency)
+        with server.lock:
+            server.active -= 1
+
+    def do_POST(self):
+        self.wait()
+        length = int(self.headers['Content-Length'])
+        form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+        query = urllib.parse.urlencode({'s': form['Molecules'][0],
+                                        'a': form['MinNu'][0],
+                                        'b': form['MaxNu'][0]})
+        self.send('<html>\n<head>\n</head>\n<body>\n'
+                  '<a href="/results?%s">results</a>\n</body>\n</html>\n' % query)
+
+    def do_GET(self):
+        self.wait()
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/partfunc':
+            rows = ['<html>', '<pre>']
+            for species, tag in SPECIES.items():
+                rows.append("%6d %-21s%11d" % (tag, species[7:], 1234)
+                            + "".join("%10.4f" % v for v in np.log10(
+                                [5000., 2000, 1000, 700, 400, 200, 100, 50, 25])))
+            rows.append('</pre>')
+            return self.send("\n".join(rows) + "\n")
+        query = urllib.parse.parse_qs(url.query)
+        fmin = float(query['a'][0]) * 1e3
+        fmax = float(query['b'][0]) * 1e3
+        rows = [row for f, row in CATALOGS.get(query['s'][0], [])
+                if fmin <= f <= fmax]
+        self.send("\n".join(["header"] * 10 + rows + ["</pre>"]) + "\n")
+
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server(monkeypatch, tmp_path):
+    srv = Server(('127.0.0.1', 0), Handler)
+    srv.lock = threading.Lock()
+    srv.latency = 0.2
+    srv.requests = 0
+    srv.active = 0
+    srv.max_active = 0
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+
+    url = "http://127.0.0.1:%d" % srv.server_address[1]
+    for name in ('http_proxy', 'HTTP_PROXY', 'https_proxy', 'HTTPS_PROXY'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(cdms, 'partfunc_url', url + '/partfunc')
+    monkeypatch.setattr(cdms, 'partfunc_file', str(tmp_path / 'partfunc.json'))
+    monkeypatch.setattr(cdms, 'partfuncsCached', None)
+    srv.url = url + '/cdmssearch'
+
+    yield srv
+
+    srv.shutdown()
+    srv.server_close()
+
+
+def database(server):
+    return cdms.Cdms(url=server.url, cache_file="", protocol="cdms_post",
+                     online=True, name="cdms")
+
+
+def components():
+    found = []
+    for species in SPECIES:
+        c = modsource.component()
+        c.species = species
+        c.origin = 'All'
+        c.Ntot = 1e15
+        c.Tex = 30.
+        c.theta = 2.
+        c.v_off = 0.
+        c.delta_v = 1.2
+        c.absorption = False
+        c.keep_opacity = False
+        found.append(c)
+    return found
+
+
+def test_prefetch_overlaps_requests(server):
+    start = time.time()
+    fetched = modsource.prefetch(database(server), components(), 100000., 101000.)
+    elapsed = time.time() - start
+
+    # A POST and a GET per species, and the partition function table
+    assert server.requests == 2 * len(SPECIES) + 1
+    assert server.max_active > 1
+    assert elapsed < server.requests * server.latency
+    for c in components():
+        assert len(fetched[(c.species, c.origin)]) > 0
+
+
+def test_modsource_cache_file_needs_no_request(server, tmp_path):
+    cache_file = str(tmp_path / 'lines.db')
+    first = modsource.modsource(components(), 100000., 101000., theta_tel=10.,
+                                cache_file=cache_file, database=database(server))
+    assert server.requests > 0
+    assert os.path.isfile(cache_file)
+
+    # Lines and partition functions must now all come from the cache
+    server.requests = 0
+    cdms.partfuncsCached = None
+    os.remove(cdms.partfunc_file)
+    second = modsource.modsource(components(), 100000., 101000., theta_tel=10.,
+                                 cache_file=cache_file, database=database(server))
+    assert server.requests == 0
+    np.testing.assert_array_equal(first[0], second[0])
+    np.testing.assert_array_equal(first[1], second[1])
+
+
+def test_cdms_through_http_proxy(server, monkeypatch):
+    # The stand-in answers requests for any host, so it can act as a
+    # proxy for a host that does not exist
+    monkeypatch.setenv('HTTP_PROXY', server.url.rsplit('/', 1)[0])
+    proxied = cdms.Cdms(url="http://cdms.invalid/cdmssearch", cache_file="",
+                        protocol="cdms_post", online=True, name="cdms")
+    lines = proxied.search_array(100000., 101000., species='029501 C-13-O')
+    assert server.requests == 2
+    assert len(lines) > 0
+
+
+def reference_modsource(cdmsobject, components, fmin, fmax, freq_step,
+                        theta_tel, background=2.7):
+    # modsource as it was before the opacity kernel was vectorized:
+    # lines are added one at a time
+    from weeds_py.consts import (speed_of_light, planck_constant,
+                                 boltzmann_constant)
+
+    freq = np.arange(fmin, fmax, freq_step)
+    tb_grand_tot = np.zeros(len(freq))
+    for c in components:
+        lines = cdmsobject.search(fmin, fmax, species=c.species, origin=c.origin)
+        tau_tot = np.zeros(len(freq))
+        if len(lines) == 0:
+            continue
+        temperature, partfunc = cdmsobject.part_function(c.species, 'cdms', 'cdms')
+        order = np.argsort(temperature)
+        partitionfunc = np.exp(np.interp(np.log(c.Tex),
+                                         np.log(np.asarray(temperature)[order]),
+                                         np.log(np.asarray(partfunc)[order])))
+        for l in lines:
+            freq_off = -c.v_off * 1e3 / speed_of_light * l.frequency
+            sigma = l.frequency / (speed_of_light * np.sqrt(8 * np.log(2))) \
+                * c.delta_v * 1e3 * 1e6
+            phi = 1 / (sigma * np.sqrt(2 * np.pi)) \
+                * np.exp(-((freq - l.frequency - freq_off) * 1e6)**2 / (2 * sigma**2))
+            tau_tot = tau_tot + speed_of_light**2 / (8 * np.pi * (freq * 1e6)**2) \
+                * l.einstein_coefficient * c.Ntot * 1e4 \
+                * l.upper_level.statistical_weight \
+                * np.exp(-l.upper_level.energy / c.Tex) / partitionfunc \
+                * (np.exp(planck_constant * l.frequency * 1e6
+                          / (c.Tex * boltzmann_constant)) - 1) * phi
+
+        eta_source = c.theta**2 / (theta_tel**2 + c.theta**2)
+        tb_tot = eta_source * (modsource.J(c.Tex, freq) - modsource.J(background, freq)) \
+            * (1 - np.exp(-tau_tot))
+        if not c.absorption:
+            tb_grand_tot = tb_grand_tot + tb_tot
+        else:
+            tb_grand_tot = tb_grand_tot * np.exp(-tau_tot) + tb_tot
+
+    return freq, tb_grand_tot
+
+
+def test_vectorized_opacity_matches_line_loop(server):
+    server.latency = 0.
+    found = components()
+    found[1].absorption = True
+    found[2].Tex = 80.
+    found[2].v_off = 2.5
+    freq_step = 0.05
+
+    freq, tb = modsource.modsource(found, 100000., 102000., freq_step=freq_step,
+                                   theta_tel=10., database=database(server))[:2]
+    ref_freq, ref_tb = reference_modsource(database(server), found, 100000., 102000.,
+                                           freq_step, theta_tel=10.)
+
+    np.testing.assert_array_equal(freq, ref_freq)
+    assert tb.max() > 0
+    assert np.allclose(tb, ref_tb, rtol=1e-10, atol=1e-12)
+
+
+def test_parallel_modes_give_the_same_spectrum(server):
+    server.latency = 0.
+    found = components()
+    found[1].absorption = True
+    found[2].v_off = 2.5
+
+    spectra = {}
+    for parallel in (None, 'thread', 'process'):
+        spectra[parallel] = modsource.modsource(found, 100000., 102000., freq_step=0.05,
+                                                theta_tel=10., database=database(server),
+                                                parallel=parallel, workers=2)
+    for parallel in ('thread', 'process'):
+        assert np.array_equal(spectra[None][0], spectra[parallel][0])
+        assert np.array_equal(spectra[None][1], spectra[parallel][1])
+    assert spectra[None][1].max() > 0
+
+
+def test_modsource_grid_matches_modsource(server):
+    server.latency = 0.
+    found = components()
+    found[1].absorption = True
+    # A species the stand-in has no lines for
+    empty = components()[0]
+    empty.species = '044501 CS'
+    found.append(empty)
+
+    Tex, Ntot = np.meshgrid([20., 50.], [1e14, 1e15])
+    Tex = Tex.ravel()
+    Ntot = Ntot.ravel()
+    v_off = np.array([0., 1., 2., 3.])[:, None] * np.ones(len(found))
+    freq_step = 0.05
+
+    freq, tb = modsource.modsource_grid(found, 100000., 102000., Ntot=Ntot, Tex=Tex,
+                                        v_off=v_off, freq_step=freq_step, theta_tel=10.,
+                                        database=database(server))[:2]
+    assert tb.shape == (len(Tex), len(freq))
+    for j in range(len(Tex)):
+        for k, c in enumerate(found):
+            c.Tex = Tex[j]
+            c.Ntot = Ntot[j]
+            c.v_off = v_off[j, k]
+        ref_freq, ref_tb = modsource.modsource(found, 100000., 102000., freq_step=freq_step,
+                                               theta_tel=10., database=database(server))[:2]
+        np.testing.assert_array_equal(freq, ref_freq)
+        assert ref_tb.max() > 0
+        assert np.allclose(tb[j], ref_tb, rtol=1e-10, atol=1e-12)
+
+    # Models of components without lines are empty
+    freq, tb = modsource.modsource_grid([empty], 100000., 102000., Tex=Tex,
+                                        freq_step=freq_step, theta_tel=10.,
+                                        database=database(server))[:2]
+    assert tb.shape == (len(Tex), len(freq))
+    assert not tb.any()
@@ -1 +1 @@
-__all__ = ['cache', 'consts','derivelineflux','modsource','cdms','db','line','sicparse']
+__all__ = ['cache', 'consts','derivelineflux','modsource','cdms','db','line','sicparse','httppool','catfile','federated']
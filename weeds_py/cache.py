@@ -4,12 +4,39 @@
 import sqlite3
 import array
 import os
+import threading
+import urllib.parse
+import numpy
 from . import line
 from datetime import datetime
 
 origins = ["voparis", "vamdc", "splatalogue", "cdms", "jpl"]
 blankPartfunc = -1
 
+# Version of the cache file layout, stored as the SQLite user_version:
+# 0 -- numeric columns of the line table bound as "%.17f" strings
+# 1 -- numeric columns bound as floats (see Cache.migrate)
+# 2 -- frequency indices on the line table
+schemaVersion = 2
+
+# Numeric columns of the line table
+numericColumns = ["frequency", "uncertainty", "einstein_coefficient",
+                  "upper_level_energy", "upper_level_statistical_weight",
+                  "lower_level_energy", "lower_level_statistical_weight"]
+
+# Columns of the line table, in order
+lineColumns = ["species", "frequency", "uncertainty", "einstein_coefficient",
+               "upper_level_energy", "upper_level_statistical_weight",
+               "upper_level_quantum_numbers", "lower_level_energy",
+               "lower_level_statistical_weight", "lower_level_quantum_numbers",
+               "origin", "dbsource", "date"]
+
+# Pragmas used during bulk loads. The journal is kept in memory and we do
+# not wait for the data to reach the disk, so a crash during a load may
+# corrupt the file, but a load can always be redone.
+bulkPragmas = [("journal_mode", "memory"), ("synchronous", "off"),
+               ("cache_size", -200000)]
+
 class NotFoundError(Exception):
    pass
 
@@ -23,18 +50,51 @@ class Cache:
 
    """
 
-   def __init__(self, dbfile):
-      self.db_file = dbfile
+   def __init__(self, dbfile, concurrent=False, timeout=60):
+      """
+      Arguments:
+      dbfile     -- the database file name
+      concurrent -- set up the file for concurrent access (default False):
+                    write-ahead logging, so that readers do not block on
+                    writers, and separate read-only connections for searches
+      timeout    -- time to wait for a lock held by another connection
+                    before failing, in seconds (default 60)
 
-   def connect(self, new):
+      """
+
+      self.db_file = dbfile
+      self.concurrent = concurrent
+      self.timeout = timeout
+      self.wal = False
+      # One connection per thread, as sqlite3 connections should not be
+      # shared between threads. All of them are kept, with their thread,
+      # so that close() can close them. Those of finished threads (e.g.
+      # of thread pools) are closed when new connections are opened.
+      self.local = threading.local()
+      self.connections = []
+      self.lock = threading.Lock()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.close()
+
+   def connect(self, new, readonly=False):
       """SQlite3-connect to the associated file and return the Connection
       instance.
 
+      The connection is opened on the first call from a given thread,
+      and reused afterwards until close() is called. In concurrent mode,
+      the file is switched to write-ahead logging and read-only
+      connections are kept apart from the read-write ones.
+
       Parameters:
       -----------
        filename: the database file name
        new: if True, the file may or may not exist before.
             if False, the file must exist.
+       readonly: if True, the connection is only used for reading.
       """
 
       if not new:
@@ -45,8 +105,52 @@ class Cache:
           # been deleted after the USE.
           raise Exception("Database file does not exist: "+self.db_file)
 
-      return sqlite3.connect(self.db_file)
+      readonly = readonly and self.concurrent
+      if readonly and not self.wal:
+         # Read-only connections cannot change the journal mode
+         self.connect(new)
+
+      attr = "reader" if readonly else "connection"
+      db_connect = getattr(self.local, attr, None)
+      if db_connect is None:
+         # check_same_thread is disabled only so that close() may be
+         # called from any thread; each connection is used by the thread
+         # that opened it.
+         if readonly:
+            uri = "file:" + urllib.parse.quote(os.path.abspath(self.db_file)) + "?mode=ro"
+            db_connect = sqlite3.connect(uri, uri=True, timeout=self.timeout,
+                                         check_same_thread=False)
+         else:
+            db_connect = sqlite3.connect(self.db_file, timeout=self.timeout,
+                                         check_same_thread=False)
+            if self.concurrent:
+               db_connect.execute("pragma journal_mode = wal;")
+               self.wal = True
+         setattr(self.local, attr, db_connect)
+         with self.lock:
+            for thread, connection in self.connections:
+               if not thread.is_alive():
+                  connection.close()
+            self.connections = [(thread, connection) for thread, connection in self.connections
+                                if thread.is_alive()]
+            self.connections.append((threading.current_thread(), db_connect))
+
+      return db_connect
+
+   def close(self):
+      """
+      Close the connections to the database file
 
+      They are opened again as needed.
+
+      """
+
+      with self.lock:
+         for thread, db_connect in self.connections:
+            db_connect.close()
+         self.connections = []
+         self.local = threading.local()
+         self.wal = False
 
    def create(self, version, fmin=None, fmax=None, overwrite = False):
       """
@@ -63,6 +167,7 @@ class Cache:
 
       if os.path.isfile(self.db_file):
          if overwrite:
+            self.close()
             os.remove(self.db_file)
          else:
             raise ValueError("Database file {0} already exists.".format(self.db_file))
@@ -85,15 +190,15 @@ class Cache:
                     "'date' char(32),"
                     "constraint sqod unique (species, upper_level_quantum_numbers, lower_level_quantum_numbers, origin, dbsource)"
                     ");")
-# Those would most likely be the most useful indices. However, as sqlite
-# implements a unique constraint as an index, we already have an, albeit
-# not so good, index with specquantori. As a result, adding one of those
-# indices would not improve things much, - actually some crude benchmarks
-# showed that there's even a decrease in speed, probably because the engine
-# has to take the time to evaluate which index is the most adequate -
-# for quite the added cost in size. Hence why we decided against an index.
-#      db_cursor.execute("create index 'lspecfreq' on line('species', 'frequency');")
-#      db_cursor.execute("create index 'lorispecfreq' on line('origin', 'species', 'frequency');")
+# We used to rely on the index sqlite makes for the unique constraint
+# (specquantori) only, as crude benchmarks on small caches showed no gain
+# from the indices below. On multi-million line caches, however, a search
+# without species selection is a full table scan (~200 ms per query for 2e6
+# lines, whatever the window), and a search for one species walks all the
+# lines of that species (~17 ms). With the frequency indices, narrow windows
+# take ~0.05 ms, and the query planner picks lspecfreq when the search is on
+# given species, lfreq otherwise. They cost about 40% in file size.
+      self.__create_indices(db_cursor)
       db_cursor.execute("create table partfunc ("
                     "'species' char(32),"
                     "'temperature' blob,"
@@ -103,6 +208,7 @@ class Cache:
                     "constraint spec unique (species, origin, dbsource)"
                     ");")
       db_cursor.execute("create index 'pfspecies' on partfunc('species');")
+      self.__create_coverage(db_cursor)
       # Note: min_frequency, and max_frequency used to be in there, but we had
       # to get them from line table to keep them up to date anyway.
       # I'd remove the whole table altogether. Just keeping it around it case
@@ -112,6 +218,7 @@ class Cache:
                     ");")
       # Note: comma is necessary, otherwise it's not considered a tuple.
       db_cursor.execute("insert into info values (?);", (version,))
+      db_cursor.execute("pragma user_version = %d;" % schemaVersion)
       db_cursor.execute("create trigger syncPartfunc after delete on line "
       "when (select species from line where species = old.species and origin = old.origin and dbsource = old.dbsource) is null "
       "begin delete from partfunc where species = old.species and origin = old.origin and dbsource = old.dbsource; end;"
@@ -120,6 +227,84 @@ class Cache:
       db_connect.commit()
       db_cursor.close()
 
+   def schema_version(self):
+      """
+      Returns the layout version of the cache file (see schemaVersion)
+
+      """
+
+      db_connect = self.connect(new=False)
+      version = db_connect.execute("pragma user_version;").fetchone()[0]
+
+      return version
+
+   def migrate(self):
+      """
+      Convert a cache file to the current layout, in place
+
+      The frequency indices of schema version 2 are created if needed.
+      Files made before schema version 1 bound the numeric columns of the
+      line table as "%.17f" strings. The column affinity stored most of them
+      as reals already, but the values that could not be converted this way
+      (e.g. "inf") were kept as text. Those are converted, and the file is
+      vacuumed. Note that the precision lost by the formatting (e.g. on small
+      Einstein coefficients) cannot be recovered; lines must be fetched
+      again for that.
+
+      """
+
+      db_connect = self.connect(new=False)
+      db_cursor = db_connect.cursor()
+      db_cursor.execute("pragma user_version;")
+      if db_cursor.fetchone()[0] >= schemaVersion:
+         db_cursor.close()
+         return
+
+      for column in numericColumns:
+         db_cursor.execute("update line set {0} = cast({0} as real) "
+                           "where typeof({0}) != 'real';".format(column))
+      self.__create_indices(db_cursor)
+      db_cursor.execute("pragma user_version = %d;" % schemaVersion)
+      db_connect.commit()
+      db_cursor.close()
+      # vacuum cannot run within a transaction
+      db_connect.execute("vacuum;")
+
+   @staticmethod
+   def __create_indices(db_cursor):
+      db_cursor.execute("create index if not exists 'lfreq' on line('frequency');")
+      db_cursor.execute("create index if not exists 'lspecfreq' on line('species', 'frequency');")
+
+   @staticmethod
+   def __has_table(db_cursor, table):
+      # Whether a table exists, without writing to the file (which may be
+      # read-only)
+      db_cursor.execute("select count(*) from sqlite_master where type = 'table' and name = ?;",
+                        (table, ))
+      return db_cursor.fetchone()[0] > 0
+
+   @staticmethod
+   def __create_coverage(db_cursor):
+      # Frequency ranges already fetched from a remote database, for each
+      # query species (see ReadThrough). The species names of the lines
+      # returned by a query may differ from the query itself (e.g. CDMS
+      # drops the species tag), so we keep track of them as well. These
+      # tables are created on demand for cache files made before they
+      # existed.
+      db_cursor.execute("create table if not exists coverage ("
+                    "'query' char(32),"
+                    "'fmin' real,"
+                    "'fmax' real,"
+                    "'dbsource' char(32)"
+                    ");")
+      db_cursor.execute("create index if not exists 'covquery' on coverage('query', 'dbsource');")
+      db_cursor.execute("create table if not exists coverage_species ("
+                    "'query' char(32),"
+                    "'species' char(32),"
+                    "'dbsource' char(32),"
+                    "constraint qsd unique (query, species, dbsource)"
+                    ");")
+
    @staticmethod
    def __execute_insert_line(db_cursor, line):
       # dirty hack: even though we're not in the upsert case, we still want to
@@ -131,13 +316,13 @@ class Cache:
       else:
          dt = line.date
          action = 'insert into line '
-      fr = "%.17f" % line.frequency
-      err = "%.17f" % line.err_frequency
-      ec = "%.17f" % line.einstein_coefficient
-      ue = "%.17f" % line.upper_level.energy
-      usw = "%.17f" % line.upper_level.statistical_weight
-      le = "%.17f" % line.lower_level.energy
-      lsw = "%.17f" % line.lower_level.statistical_weight
+      fr = float(line.frequency)
+      err = float(line.err_frequency)
+      ec = float(line.einstein_coefficient)
+      ue = float(line.upper_level.energy)
+      usw = float(line.upper_level.statistical_weight)
+      le = float(line.lower_level.energy)
+      lsw = float(line.lower_level.statistical_weight)
       db_cursor.execute(action + "values (?,?,?,?,?,?,?,?,?,?,?,?,?);",
                      (line.species, fr, err, ec, ue, usw, line.upper_level.quantum_numbers,
                       le, lsw, line.lower_level.quantum_numbers, line.origin, line.dbsource, dt)
@@ -149,13 +334,13 @@ class Cache:
          dt = datetime.utcnow().isoformat()
       else:
          dt = line.date
-      fr = "%.17f" % line.frequency
-      err = "%.17f" % line.err_frequency
-      ec = "%.17f" % line.einstein_coefficient
-      ue = "%.17f" % line.upper_level.energy
-      usw = "%.17f" % line.upper_level.statistical_weight
-      le = "%.17f" % line.lower_level.energy
-      lsw = "%.17f" % line.lower_level.statistical_weight
+      fr = float(line.frequency)
+      err = float(line.err_frequency)
+      ec = float(line.einstein_coefficient)
+      ue = float(line.upper_level.energy)
+      usw = float(line.upper_level.statistical_weight)
+      le = float(line.lower_level.energy)
+      lsw = float(line.lower_level.statistical_weight)
       db_cursor.execute("insert or replace into line "
                        "values (?,?,?,?,?,?,?,?,?,?,?,?,?);",
                      (line.species, fr, err, ec, ue, usw, line.upper_level.quantum_numbers,
@@ -164,8 +349,8 @@ class Cache:
 
    @staticmethod
    def __execute_insert_partfunc(db_cursor, species, temperature, partfunc, origin, dbsource):
-      t = sqlite3.Binary(array.array('d', temperature).tostring())
-      p = sqlite3.Binary(array.array('d', partfunc).tostring())
+      t = sqlite3.Binary(array.array('d', temperature).tobytes())
+      p = sqlite3.Binary(array.array('d', partfunc).tobytes())
 
       query = '''insert into partfunc values(?,?,?,?,?)'''
       db_cursor.execute(query, (species, t, p, origin, dbsource))
@@ -173,8 +358,8 @@ class Cache:
    @staticmethod
    def __execute_upsert_partfunc(db_cursor, species, temperature, partfunc, origin, dbsource):
 
-      t = sqlite3.Binary(array.array('d', temperature).tostring())
-      p = sqlite3.Binary(array.array('d', partfunc).tostring())
+      t = sqlite3.Binary(array.array('d', temperature).tobytes())
+      p = sqlite3.Binary(array.array('d', partfunc).tobytes())
 
       query = '''insert or replace into partfunc values(?,?,?,?,?)'''
       db_cursor.execute(query, (species, t, p, origin, dbsource))
@@ -228,6 +413,114 @@ class Cache:
       db_connect.commit()
       db_cursor.close()
 
+   @staticmethod
+   def __line_rows(lines):
+      # Rows of the line table from line objects
+      for line in lines:
+         yield (line.species, float(line.frequency), float(line.err_frequency),
+                float(line.einstein_coefficient), float(line.upper_level.energy),
+                float(line.upper_level.statistical_weight),
+                line.upper_level.quantum_numbers, float(line.lower_level.energy),
+                float(line.lower_level.statistical_weight),
+                line.lower_level.quantum_numbers, line.origin, line.dbsource,
+                line.date)
+
+   @staticmethod
+   def __column_rows(columns):
+      # Rows of the line table from a dict of columns (see lineColumns). The
+      # date column is optional.
+      n = len(columns["frequency"])
+      cols = [columns[c] if c in columns else [""] * n for c in lineColumns]
+      for row in zip(*cols):
+         yield (str(row[0]), float(row[1]), float(row[2]), float(row[3]),
+                float(row[4]), float(row[5]), str(row[6]), float(row[7]),
+                float(row[8]), str(row[9]), str(row[10]), str(row[11]),
+                str(row[12]))
+
+   def add_lines_bulk(self, lines, update, batch_size=50000):
+      """
+      Add lines to the database in bulk
+
+      Lines are inserted with executemany, by batches of batch_size lines,
+      each in a single transaction, and with pragmas tuned for bulk loads
+      (see bulkPragmas). The semantics are the same as for add_lines:
+      lines that are already present are skipped, unless update is True
+      or the lines come from an online database or a .cat file, in which
+      case they are replaced.
+
+      Arguments:
+      lines      -- iterable of line objects, dict of columns (arrays or
+                    lists) named as in lineColumns, or structured array (see
+                    line.dtype)
+      update     -- replace the lines already present
+      batch_size -- number of lines per transaction
+
+      Returns the number of inserted and skipped lines.
+
+      """
+
+      if isinstance(lines, numpy.ndarray):
+         rows = self.__column_rows({c: lines[c].tolist() for c in lines.dtype.names})
+      elif isinstance(lines, dict):
+         rows = self.__column_rows(lines)
+      else:
+         rows = self.__line_rows(lines)
+
+      insert = "insert or ignore into line values (?,?,?,?,?,?,?,?,?,?,?,?,?);"
+      replace = "insert or replace into line values (?,?,?,?,?,?,?,?,?,?,?,?,?);"
+      now = datetime.utcnow().isoformat()
+
+      db_connect = self.connect(new=False)
+      db_cursor = db_connect.cursor()
+      saved = []
+      for pragma, value in bulkPragmas:
+         if pragma == "journal_mode" and self.concurrent:
+            # keep write-ahead logging, so that readers are not blocked
+            continue
+         db_cursor.execute("pragma %s;" % pragma)
+         saved.append((pragma, db_cursor.fetchone()[0]))
+         db_cursor.execute("pragma %s = %s;" % (pragma, value))
+
+      inserted = 0
+      skipped = 0
+      try:
+         done = False
+         while not done:
+            to_insert = []
+            to_replace = []
+            for i, (species, fr, err, ec, ue, usw, uqn, le, lsw, lqn, origin, dbsource, dt) \
+                  in zip(range(batch_size), rows):
+               # Same dates as __execute_insert_line and
+               # __execute_upsert_line
+               if update:
+                  target = to_replace
+                  if origin in origins:
+                     dt = now
+               elif dbsource in origins or ".cat" in dbsource:
+                  target = to_replace
+                  dt = now
+               else:
+                  target = to_insert
+               target.append((species, fr, err, ec, ue, usw, uqn, le, lsw,
+                              lqn, origin, dbsource, dt))
+            if len(to_insert) + len(to_replace) < batch_size:
+               done = True
+            if to_insert:
+               db_cursor.executemany(insert, to_insert)
+               inserted += db_cursor.rowcount
+               skipped += len(to_insert) - db_cursor.rowcount
+            if to_replace:
+               db_cursor.executemany(replace, to_replace)
+               inserted += len(to_replace)
+            db_connect.commit()
+      finally:
+         db_connect.commit()
+         for pragma, value in saved:
+            db_cursor.execute("pragma %s = %s;" % (pragma, value))
+         db_cursor.close()
+
+      return inserted, skipped
+
    def add_partfunc(self, species, temperature, partfunc, origin, dbsource, update):
       """
       Add a partition function to the database
@@ -303,15 +596,116 @@ class Cache:
 #         "select species, origin from line group by species);")
 #      db_connect.commit()
 
+   def covered(self, query, fmin, fmax, dbsource):
+      """
+      Returns the species names of the lines cached for a query, or None
+      if the frequency range has not been fetched entirely yet
+
+      Arguments:
+      query    -- the species name used in the query to dbsource
+      fmin     -- the minimum frequency in MHz
+      fmax     -- the maximum frequency in MHz (or -1 for no limit)
+      dbsource -- the name of the database the lines come from
+
+      """
+
+      if fmin < 0:
+         fmin = 0
+      if fmax < 0:
+         fmax = float("inf")
+
+      db_connect = self.connect(new=False)
+      db_cursor = db_connect.cursor()
+      if not self.__has_table(db_cursor, "coverage_species"):
+         db_cursor.close()
+         return None
+
+      # Ranges are merged when they are added, so the query range must
+      # fit in a single one.
+      db_cursor.execute("select count(*) from coverage where query = ? and dbsource = ?"
+                        " and fmin <= ? and fmax >= ?;", (query, dbsource, fmin, fmax))
+      if db_cursor.fetchone()[0] == 0:
+         db_cursor.close()
+         return None
+
+      db_cursor.execute("select species from coverage_species where query = ? and dbsource = ?;",
+                        (query, dbsource))
+      species = [row[0] for row in db_cursor]
+      db_cursor.close()
+
+      return species
+
+   def query_species(self, query):
+      """
+      Returns the species names of the lines cached for a query, from
+      any database and frequency range (see covered)
+
+      Arguments:
+      query -- the species name used in the query to the database
+
+      """
+
+      db_connect = self.connect(new=False)
+      db_cursor = db_connect.cursor()
+      if not self.__has_table(db_cursor, "coverage_species"):
+         db_cursor.close()
+         return []
+      db_cursor.execute("select distinct species from coverage_species where query = ?;",
+                        (query, ))
+      species = [row[0] for row in db_cursor]
+      db_cursor.close()
+
+      return species
+
+   def add_coverage(self, query, fmin, fmax, dbsource, species):
+      """
+      Record that a frequency range has been fetched for a query
+
+      The new range is merged with the ranges it overlaps.
+
+      Arguments:
+      query    -- the species name used in the query to dbsource
+      fmin     -- the minimum frequency in MHz
+      fmax     -- the maximum frequency in MHz (or -1 for no limit)
+      dbsource -- the name of the database the lines come from
+      species  -- species names of the lines returned by the query
+
+      """
+
+      if fmin < 0:
+         fmin = 0
+      if fmax < 0:
+         fmax = float("inf")
+
+      db_connect = self.connect(new=False)
+      db_cursor = db_connect.cursor()
+      self.__create_coverage(db_cursor)
+
+      args = (query, dbsource, fmax, fmin)
+      db_cursor.execute("select min(fmin), max(fmax) from coverage where query = ? and dbsource = ?"
+                        " and fmin <= ? and fmax >= ?;", args)
+      row = db_cursor.fetchone()
+      if row[0] is not None:
+         fmin = min(fmin, row[0])
+         fmax = max(fmax, row[1])
+      db_cursor.execute("delete from coverage where query = ? and dbsource = ?"
+                        " and fmin <= ? and fmax >= ?;", args)
+      db_cursor.execute("insert into coverage values (?,?,?,?);", (query, fmin, fmax, dbsource))
+      for spec in set(species):
+         db_cursor.execute("insert or ignore into coverage_species values (?,?,?);",
+                           (query, spec, dbsource))
+      db_connect.commit()
+      db_cursor.close()
+
    def info(self):
       """
       Display informations on the database
 
       """
 
-      db_connect = self.connect(new=False)
-      db_connect.row_factory = sqlite3.Row
+      db_connect = self.connect(new=False, readonly=True)
       db_cursor = db_connect.cursor()
+      db_cursor.row_factory = sqlite3.Row
       db_cursor.execute( "select * from info")
       row = db_cursor.fetchone()
       version = row['version']
@@ -331,7 +725,7 @@ class Cache:
 
    def remove(self, lines):
       db_connect = self.connect(new=False)
-      db_connect.row_factory = sqlite3.Row
+      self.__create_coverage(db_connect.cursor())
 
       query = "delete from line"
 
@@ -341,24 +735,16 @@ class Cache:
          lquery += " and lower_level_quantum_numbers = ?"
          args = (l.species, l.origin, l.prev, l.upper_level.quantum_numbers, l.lower_level.quantum_numbers)
          db_connect.execute(lquery, args)
+         # The ranges fetched for that species are not complete anymore.
+         db_connect.execute("delete from coverage where dbsource = ? and query in "
+                            "(select query from coverage_species where species = ? and dbsource = ?);",
+                            (l.prev, l.species, l.prev))
 
       db_connect.commit()
 
-   def search(self, fmin=-1, fmax=-1, species=[], origin='All', dbsource='All', energy=-1, einstein=-1):
-      """
-      Search lines in the cache
-
-      Arguments:
-      fmin   -- the minimum frequency in MHz
-      fmax   -- the maximum frequency in MHz
-      species -- the species name (a string or list of strings). String 'All'
-                 is an alias for no selection.
-      origin -- (default All)
-      energy -- maximum upper level energy expressed
-              in Kelvins (default -1)
-      einstein -- coefficient to match (default -1)
-
-      """
+   @staticmethod
+   def __search_query(columns, fmin, fmax, species, origin, dbsource, energy, einstein):
+      # Build the query and its arguments for a search (see search)
 
       if (type(species) == str):
         if (species == 'All'):
@@ -370,20 +756,13 @@ class Cache:
       else:
         raise Exception("Unexpected kind of argument: "+repr(species))
 
-      db_connect = self.connect(new=False)
-      db_connect.row_factory = sqlite3.Row
-      db_cursor = db_connect.cursor()
-
-      lines = []
       if fmin < 0:
          fmin = 0
-      fmi = "%f" % fmin
-      args = (fmi, )
-      query = "select * from line where frequency >= ?"
+      args = (float(fmin), )
+      query = "select " + columns + " from line where frequency >= ?"
       if fmax > 0:
-         fma = "%f" % fmax
          query += " and frequency <= ?"
-         args = args + (fma, )
+         args = args + (float(fmax), )
       started = False
       for s in lspecies:
          # NB: AND logical operator has precedence over OR. Must use parenthesis e.g.
@@ -401,14 +780,43 @@ class Cache:
          query += " and dbsource = ?"
          args = args + (dbsource, )
       if energy > 0:
-         uel = "%f" % energy
          query += " and upper_level_energy <= ?"
-         args = args + (uel, )
+         args = args + (float(energy), )
       if einstein > 0:
-         ein = "%f" % einstein
          query += " and einstein_coefficient >= ?"
-         args = args + (ein, )
+         args = args + (float(einstein), )
+
+      return query, args
+
+   def search(self, fmin=-1, fmax=-1, species=[], origin='All', dbsource='All', energy=-1, einstein=-1,
+              as_array=False):
+      """
+      Search lines in the cache
+
+      Arguments:
+      fmin   -- the minimum frequency in MHz
+      fmax   -- the maximum frequency in MHz
+      species -- the species name (a string or list of strings). String 'All'
+                 is an alias for no selection.
+      origin -- (default All)
+      energy -- maximum upper level energy expressed
+              in Kelvins (default -1)
+      einstein -- coefficient to match (default -1)
+      as_array -- return a structured array instead of a list of line
+                  objects (see search_array)
+
+      """
+
+      if as_array:
+         return self.search_array(fmin, fmax, species, origin, dbsource, energy, einstein)
+
+      query, args = self.__search_query("*", fmin, fmax, species, origin, dbsource, energy, einstein)
+
+      db_connect = self.connect(new=False, readonly=True)
+      db_cursor = db_connect.cursor()
+      db_cursor.row_factory = sqlite3.Row
 
+      lines = []
       db_cursor.execute(query, args)
       db_connect.commit()
       for row in db_cursor:
@@ -432,6 +840,60 @@ class Cache:
 
       return lines
 
+   def search_array(self, fmin=-1, fmax=-1, species=[], origin='All', dbsource='All', energy=-1, einstein=-1,
+                    chunk_size=100000):
+      """
+      Search lines in the cache, and return them as a structured array
+
+      This is the same as search, but rows are fetched by chunks of
+      chunk_size and stored in a NumPy structured array of type line.dtype,
+      without building a line object per row.
+
+      """
+
+      query, args = self.__search_query(", ".join(line.dtype.names), fmin, fmax,
+                                        species, origin, dbsource, energy, einstein)
+
+      db_connect = self.connect(new=False, readonly=True)
+      db_cursor = db_connect.cursor()
+      db_cursor.execute(query, args)
+
+      chunks = []
+      while True:
+         rows = db_cursor.fetchmany(chunk_size)
+         if not rows:
+            break
+         chunks.append(line.array(rows))
+      db_cursor.close()
+
+      if len(chunks) == 0:
+         return numpy.zeros(0, dtype=line.dtype)
+      if len(chunks) == 1:
+         return chunks[0]
+
+      return numpy.concatenate(chunks)
+
+   def search_windows(self, windows, species=[], origin='All', dbsource='All', energy=-1, einstein=-1,
+                      as_array=False, gap=0.):
+      """
+      Search lines in several frequency windows
+
+      Windows that overlap or are less than gap apart are searched at
+      once (see search_windows).
+
+      Arguments:
+      windows -- list of (fmin, fmax) windows, in MHz
+      gap     -- the maximum distance in MHz between merged windows
+
+      Other arguments are the same as for search. Returns a list of
+      lines per window.
+
+      """
+
+      return search_windows(self, windows, gap, species=species, origin=origin,
+                            dbsource=dbsource, energy=energy, einstein=einstein,
+                            as_array=as_array)
+
    def partition_function(self, species, origin, dbsource):
       """
       Returns the partition function at different temperatures
@@ -444,9 +906,9 @@ class Cache:
 
       """
 
-      db_connect = self.connect(new=False)
-      db_connect.row_factory = sqlite3.Row
+      db_connect = self.connect(new=False, readonly=True)
       db_cursor = db_connect.cursor()
+      db_cursor.row_factory = sqlite3.Row
 
       spec = "%s" % species
       ori = "%s" % origin
@@ -459,8 +921,8 @@ class Cache:
       partfunc = array.array('d', [])
 
       for row in db_cursor:
-         temperature.fromstring(row['temperature'])
-         partfunc.fromstring(row['partfunc'])
+         temperature.frombytes(row['temperature'])
+         partfunc.frombytes(row['partfunc'])
          break
 
       if len(partfunc) == 0 or partfunc[0] == blankPartfunc:
@@ -471,7 +933,228 @@ class Cache:
       # like this though.
       return temperature, partfunc
 
+class ReadThrough:
+   """
+   Read-through cache in front of a line database
+
+   Searches are served from the cache when the frequency range has
+   already been fetched for that species. Otherwise the lines are
+   fetched from the database, stored in the cache and the range is
+   recorded, so that repeated searches do not need the network.
+   Partition functions are cached in the same way.
+
+   """
+
+   def __init__(self, database, cache):
+      """
+      Arguments:
+      database -- the database to read through (e.g. a cdms.Cdms instance)
+      cache    -- the Cache instance (the cache file must exist)
+
+      """
+
+      self.database = database
+      self.cache = cache
+      self.name = database.name
+
+   def __fetch(self, fmin, fmax, species):
+      # Make sure the range is in the cache for that species, and return the
+      # species names of the cached lines.
+
+      cached = self.cache.covered(species, fmin, fmax, self.name)
+      if cached is None:
+         # Fetch the whole range without energy or einstein selection, so
+         # that it can be reused for any later search. Lines are stored
+         # batch by batch as they are read, when the database can stream
+         # them.
+         if hasattr(self.database, "search_batches"):
+            cached = set()
+            for lines in self.database.search_batches(fmin, fmax, species=species,
+                                                      dbsource=self.name):
+               self.cache.add_lines_bulk(lines, update=False)
+               cached.update(numpy.unique(lines["species"]).tolist())
+         else:
+            lines = self.database.search(fmin, fmax, species=species, dbsource=self.name)
+            if lines is None:
+               return None
+            self.cache.add_lines_bulk(lines, update=False)
+            cached = [l.species for l in lines]
+         self.cache.add_coverage(species, fmin, fmax, self.name, cached)
+
+      return list(set(cached))
+
+   def search(self, fmin, fmax, species='All', origin='All', dbsource='All', energy=-1, einstein=-1,
+              as_array=False):
+      """
+      Search lines in the cache, fetching them from the database first
+      if needed
+
+      Arguments are the same as for the database search. If as_array is
+      True, a structured array is returned (see search_array).
+
+      """
+
+      if as_array:
+         return self.search_array(fmin, fmax, species, origin, dbsource, energy, einstein)
+
+      if dbsource != 'All' and dbsource != self.name:
+         return []
+
+      cached = self.__fetch(fmin, fmax, species)
+      if cached is None:
+         return None
+      if len(cached) == 0:
+         return []
+
+      return self.cache.search(fmin, fmax, species=cached, origin=origin,
+                               dbsource=self.name, energy=energy, einstein=einstein)
+
+   def search_array(self, fmin, fmax, species='All', origin='All', dbsource='All', energy=-1, einstein=-1):
+      """
+      Same as search, but returns a structured array of type line.dtype
+
+      """
+
+      if dbsource != 'All' and dbsource != self.name:
+         return numpy.zeros(0, dtype=line.dtype)
+
+      cached = self.__fetch(fmin, fmax, species)
+      if not cached:
+         return numpy.zeros(0, dtype=line.dtype)
+
+      return self.cache.search_array(fmin, fmax, species=cached, origin=origin,
+                                     dbsource=self.name, energy=energy, einstein=einstein)
+
+   def search_windows(self, windows, species='All', origin='All', dbsource='All', energy=-1, einstein=-1,
+                      as_array=False, gap=0.):
+      """
+      Search lines in several frequency windows (see
+      Cache.search_windows)
+
+      """
+
+      return search_windows(self, windows, gap, species=species, origin=origin,
+                            dbsource=dbsource, energy=energy, einstein=einstein,
+                            as_array=as_array)
+
+   def part_function(self, species, origin, dbsource):
+      """
+      Returns the partition function at different temperatures, from
+      the cache or else from the database
+
+      Arguments:
+      species -- the species name
+
+      """
+
+      try:
+         return self.cache.partition_function(species, origin, dbsource)
+      except NotFoundError:
+         temperature, partfunc = self.database.part_function(species, origin, dbsource)
+         self.cache.add_partfunc(species, temperature, partfunc, origin, dbsource, update=True)
+         return temperature, partfunc
+
+def merge_windows(windows, gap=0., max_width=None):
+   """
+   Merge frequency windows
+
+   Windows that overlap, or that are less than gap apart, are merged
+   into a single window, unless the merged window would be wider than
+   max_width.
+
+   Arguments:
+   windows   -- list of (fmin, fmax) windows
+   gap       -- the maximum distance between merged windows (default 0,
+                i.e. only overlapping windows are merged)
+   max_width -- the maximum width of a merged window (default None,
+                i.e. no maximum). Windows wider than max_width are kept
+                as they are.
+
+   Returns a list of (fmin, fmax, indices) tuples, sorted by frequency,
+   where indices are the indices of the windows merged in each one.
+
+   """
+
+   merged = []
+   for i in sorted(range(len(windows)), key=lambda i: windows[i][0]):
+      fmin, fmax = windows[i]
+      if merged and fmin - merged[-1][1] <= gap \
+         and (max_width is None or max(merged[-1][1], fmax) - merged[-1][0] <= max_width):
+         merged[-1][1] = max(merged[-1][1], fmax)
+         merged[-1][2].append(i)
+      else:
+         merged.append([fmin, fmax, [i]])
+
+   return [(fmin, fmax, indices) for fmin, fmax, indices in merged]
+
+def split_windows(lines, windows):
+   """
+   Split lines between frequency windows
+
+   Arguments:
+   lines   -- list of line objects, or structured array (see line.dtype)
+   windows -- list of (fmin, fmax) windows
+
+   Returns a list with the lines of each window, in their original
+   order. A line appears in each window it falls in.
+
+   """
+
+   if isinstance(lines, numpy.ndarray):
+      frequency = lines["frequency"]
+   else:
+      frequency = numpy.array([l.frequency for l in lines], dtype=float)
+   order = numpy.argsort(frequency, kind="stable")
+   frequency = frequency[order]
+
+   split = []
+   for fmin, fmax in windows:
+      start = numpy.searchsorted(frequency, fmin, side="left")
+      stop = numpy.searchsorted(frequency, fmax, side="right")
+      indices = numpy.sort(order[start:stop])
+      if isinstance(lines, numpy.ndarray):
+         split.append(lines[indices])
+      else:
+         split.append([lines[i] for i in indices])
+
+   return split
+
+def search_windows(database, windows, gap=0., as_array=False, max_width=None, **selection):
+   """
+   Search lines of a database in several frequency windows
+
+   Windows are merged (see merge_windows), so that the database is
+   queried once per merged window, and the results are split back
+   between the windows.
+
+   Arguments:
+   database  -- the database (e.g. a Cache or cdms.Cdms instance)
+   windows   -- list of (fmin, fmax) windows, in MHz
+   gap       -- the maximum distance in MHz between merged windows
+   as_array  -- use search_array instead of search
+   max_width -- the maximum width in MHz of merged windows
+   selection -- other arguments of the search (species, origin, ...)
+
+   Returns a list with the lines of each window (None for all windows
+   if the database is not selected).
+
+   """
+
+   found = [None] * len(windows)
+   for fmin, fmax, indices in merge_windows(windows, gap, max_width):
+      if as_array:
+         lines = database.search_array(fmin, fmax, **selection)
+      else:
+         lines = database.search(fmin, fmax, **selection)
+      if lines is None:
+         continue
+      for i, window in zip(indices, split_windows(lines, [windows[i] for i in indices])):
+         found[i] = window
+
+   return found
+
 def isDbFile(dbfile):
+   conn = None
    try:
       conn = sqlite3.connect(dbfile)
       c = conn.cursor()
@@ -480,3 +1163,6 @@ def isDbFile(dbfile):
       return True
    except Exception:
       return False
+   finally:
+      if conn is not None:
+         conn.close()
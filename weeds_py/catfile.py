@@ -0,0 +1,402 @@
+# catfile.py -- linedb implementation for CDMS/JPL catalog (.cat) files
+
+import os
+import mmap
+import numpy
+from . import db
+from . import line
+from . import cdms
+from . import federated
+from .consts import *
+
+# Constants of the conversion from catalog intensities to Einstein
+# coefficients (see einstein_coefficients)
+intensityFactor = 2.7964e-16
+kelvinWavenumber = 0.695 # cm-1/K
+intensityTemperature = 300. # K
+
+# Suffix of the frequency index file, stored next to the catalog file
+indexSuffix = ".idx"
+
+class Catfile(db.Db):
+   """
+   Line database read from a catalog file of the CDMS or JPL
+
+   The species of the catalog is searched by its tag (e.g. "028503",
+   or "028503 CO" as in the CDMS), or by its name.
+
+   The catalog file is memory mapped, and a frequency index (the
+   offsets of the rows sorted by frequency) is built when the file is
+   first opened. The index is saved next to the catalog file, so that
+   it is only built again when the catalog file changes. Searches are
+   binary searches on the index, and only the rows in the frequency
+   range are parsed.
+
+   """
+
+   def __init__(self, url, cache_file="", protocol="catfile", online=False,
+                name="", species=None, origin="cdms", partfunc=None):
+      """
+      Arguments:
+      url        -- the name of the catalog file
+      cache_file -- not used
+      protocol   -- the database protocol (must be "catfile")
+      online     -- must be False
+      name       -- the name of the database (default the name of the
+                    catalog file), used as dbsource
+      species    -- the species name (default the tag of the first line,
+                    e.g. "028503")
+      origin     -- the origin of the catalog (default "cdms")
+      partfunc   -- the partition function, as (temperature, partition
+                    function) arrays (default from the CDMS partition
+                    function table, if it is loaded or saved locally, see
+                    cdms.load_partfunc and cdms.partfuncs). It is never
+                    downloaded.
+
+      A ValueError is raised if the partition function is not found,
+      since it is needed to compute the Einstein coefficients.
+
+      """
+
+      url = os.path.expanduser(url)
+      if not name:
+         name = os.path.basename(url)
+
+      db.Db.__init__(self, url, cache_file, protocol, online, name)
+
+      self.origin = origin
+      self.partfunc = partfunc
+      self.q300 = None
+
+      self.file = open(url, "rb")
+      if os.fstat(self.file.fileno()).st_size > 0:
+         self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+      else:
+         self.map = b""
+      self.index = self.__load_index()
+
+      self.tag = ""
+      if len(self.index):
+         start = self.index["start"].min()
+         self.tag = "%06d" % abs(int(self.map[start + 44:start + 51]))
+      if species is None:
+         species = self.tag
+      self.species = species
+
+      # The partition function at 300 K is needed to compute the
+      # Einstein coefficients of any search (see einstein_coefficients)
+      if len(self.index):
+         try:
+            temperature, partition_function = self.part_function(self.species, 'All', 'All')
+         except db.NotFoundError as error:
+            self.close()
+            raise ValueError("%s: %s" % (url, error))
+         # The CDMS table is in decreasing temperature order
+         order = numpy.argsort(temperature)
+         self.q300 = numpy.exp(numpy.interp(numpy.log(intensityTemperature),
+                                            numpy.log(temperature[order]),
+                                            numpy.log(partition_function[order])))
+
+   def close(self):
+      """
+      Close the catalog file
+
+      """
+
+      if isinstance(self.map, mmap.mmap):
+         self.map.close()
+      self.file.close()
+
+   def __stamp(self):
+      # Size and modification time of the catalog file, used to check
+      # whether the index is up to date
+      st = os.fstat(self.file.fileno())
+      return numpy.array([st.st_size, st.st_mtime_ns], dtype=numpy.int64)
+
+   def __load_index(self):
+      # Read the index file, or build it if it is missing or outdated
+
+      filename = self.url + indexSuffix
+      stamp = self.__stamp()
+      try:
+         with numpy.load(filename) as saved:
+            if numpy.array_equal(saved["stamp"], stamp):
+               return saved["index"]
+      except (IOError, OSError, ValueError, KeyError):
+         pass
+
+      index = build_index(self.map)
+
+      # Write to a temporary file first, so that other processes never
+      # read a partial index.
+      tmp = "%s.%d" % (filename, os.getpid())
+      try:
+         with open(tmp, "wb") as f:
+            numpy.savez(f, index=index, stamp=stamp)
+         os.replace(tmp, filename)
+      except (IOError, OSError):
+         # Not being able to keep the index is not an error
+         if os.path.exists(tmp):
+            os.remove(tmp)
+
+      return index
+
+   def __select(self, species, origin, dbsource):
+      # Whether a search selects this catalog
+
+      if origin != 'All' and origin.lower() != self.origin:  # Case-insensitive
+         return False
+
+      if dbsource != 'All' and dbsource != self.name:
+         return False
+
+      if (type(species) == str):
+         return species == 'All' or self.__matches(species)
+      elif (type(species) == list):
+         return len(species) == 0 or any(self.__matches(s) for s in species)
+      else:
+         raise Exception("Unexpected kind of argument: "+repr(species))
+
+   def __matches(self, species):
+      # Whether a species name is that of the catalog. Names are compared
+      # on their tag if they have one (e.g. "028503 CO, v=0" for a catalog
+      # of tag 028503), and otherwise without tag (e.g. "CO, v=0" for a
+      # catalog named "028503 CO, v=0").
+
+      if species == self.species:
+         return True
+      if species[:6].isdigit():
+         return species[:6] == self.tag and (len(species) == 6 or species[6] == " ")
+      return federated.species_name(species) == federated.species_name(self.species)
+
+   def search(self, fmin, fmax, species='All', origin='All', dbsource='All', energy=-1, einstein=-1,
+              as_array=False):
+      """
+      Search lines in the catalog file
+
+      Arguments:
+      fmin   -- the minimum frequency in MHz
+      fmax   -- the maximum frequency in MHz
+      species -- the species name (a string or list of strings). String 'All'
+                 is an alias for no selection.
+      energy -- maximum upper level energy expressed
+              in Kelvins (default -1)
+      einstein -- minimum Einstein coefficient (default -1)
+      as_array -- return a structured array (see line.dtype) instead of a
+                  list of line objects
+
+      """
+
+      lines = self.search_array(fmin, fmax, species, origin, dbsource, energy, einstein)
+      if as_array or lines is None:
+         return lines
+
+      return line.from_array(lines)
+
+   def search_array(self, fmin, fmax, species='All', origin='All', dbsource='All', energy=-1, einstein=-1):
+      """
+      Same as search, but returns a structured array of lines (see
+      line.dtype)
+
+      """
+
+      if not self.__select(species, origin, dbsource):
+         return
+
+      frequency = self.index["frequency"]
+      start = 0
+      if fmin > 0:
+         start = numpy.searchsorted(frequency, fmin, side="left")
+      stop = len(frequency)
+      if fmax > 0:
+         stop = numpy.searchsorted(frequency, fmax, side="right")
+
+      rows = [self.map[i:j] for i, j in self.index[["start", "stop"]][start:stop].tolist()]
+      if len(rows) == 0:
+         return numpy.zeros(0, dtype=line.dtype)
+
+      return parse_cat(rows, self.species, self.origin, self.name, self.q300,
+                       energy, einstein)
+
+   def part_function(self, species, origin, dbsource):
+      """
+      Returns the partition function at different temperatures
+
+      Unless it was given to the constructor, the partition function is
+      looked up in the CDMS partition function table, by tag and then by
+      name (e.g. "CO" for "028503 CO"), without downloading the table.
+
+      Arguments:
+      species -- the species name
+
+      """
+
+      if not self.__select(species, origin, dbsource) or species == 'All':
+         raise db.NotFoundError("No partition function found for %s." % species)
+
+      if self.partfunc is None:
+         table = cdms.partfuncs(download=False)
+         if table is None:
+            raise db.NotFoundError("No partition function found for %s: give it as"
+                                   " partfunc, or load the CDMS partition function"
+                                   " table with cdms.load_partfunc." % species)
+         name = self.species
+         if name[:6].isdigit():
+            name = name[7:].strip()
+         temperature, partition_function = table.get(self.tag) or table.get(name) or ([], [])
+      else:
+         temperature, partition_function = self.partfunc
+      if len(partition_function) == 0:
+         raise db.NotFoundError("No partition function found for %s." % species)
+
+      return numpy.array(temperature, dtype=float), numpy.array(partition_function, dtype=float)
+
+def build_index(data):
+   """
+   Build the frequency index of a catalog file
+
+   Arguments:
+   data -- the content of the file (bytes or memory map)
+
+   Returns a structured array with the frequency, and the offsets of the
+   start and end of each row, sorted by frequency.
+
+   """
+
+   dtype = [("frequency", "f8"), ("start", "i8"), ("stop", "i8")]
+
+   buf = numpy.frombuffer(data, dtype=numpy.uint8) if len(data) else numpy.zeros(0, dtype=numpy.uint8)
+   newlines = numpy.flatnonzero(buf == ord("\n"))
+   start = numpy.concatenate(([0], newlines + 1))
+   stop = numpy.concatenate((newlines, [len(buf)]))
+   keep = stop - start >= 13 # skip empty rows
+   start = start[keep]
+   stop = stop[keep]
+
+   chars = buf[start[:, None] + numpy.arange(13)]
+   frequency = numpy.ascontiguousarray(chars).view("S13").ravel().astype(float)
+
+   index = numpy.zeros(len(start), dtype=dtype)
+   index["frequency"] = frequency
+   index["start"] = start
+   index["stop"] = stop
+
+   return index[numpy.argsort(frequency, kind="stable")]
+
+def decode_int(column):
+   """
+   Decode an integer column of a catalog file
+
+   Values that do not fit in the field are written with a letter as
+   first character, e.g. "A12" for 1012 and "a12" for -1012.
+
+   Arguments:
+   column -- the column (bytes array)
+
+   """
+
+   try:
+      return column.astype(float)
+   except ValueError:
+      pass
+
+   values = numpy.empty(len(column))
+   for i, s in enumerate(column.tolist()):
+      s = s.strip()
+      if s[:1].isalpha():
+         digits = len(s) - 1
+         if s[:1].isupper():
+            values[i] = (s[0] - ord("A") + 10) * 10**digits + int(s[1:])
+         else:
+            values[i] = -((s[0] - ord("a") + 10) * 10**digits + int(s[1:]))
+      else:
+         values[i] = float(s)
+   return values
+
+def einstein_coefficients(intensity, frequency, lower_level_energy,
+                          upper_level_statistical_weight, q300):
+   """
+   Compute Einstein coefficients from catalog intensities
+
+   A = 2.7964e-16 I nu^2 Q(300) / (g_u (exp(-E_l/kT) - exp(-E_u/kT)))
+
+   with kT = 0.695 * 300 cm-1 (see Pickett et al. 1998).
+
+   Arguments:
+   intensity                      -- intensities at 300 K (nm2 MHz)
+   frequency                      -- frequencies (MHz)
+   lower_level_energy             -- lower level energies (cm-1)
+   upper_level_statistical_weight -- upper level statistical weights
+   q300                           -- the partition function at 300 K
+
+   """
+
+   kT = kelvinWavenumber * intensityTemperature
+   upper_level_energy = lower_level_energy + frequency * 1e6 / (speed_of_light * 1e2)
+   return intensityFactor * intensity * frequency**2 * q300 \
+      / (upper_level_statistical_weight
+         * (numpy.exp(-lower_level_energy / kT) - numpy.exp(-upper_level_energy / kT)))
+
+def parse_cat(rows, species, origin, name, q300, energy=-1, einstein=-1):
+   """
+   Parse rows of a catalog file
+
+   The rows are parsed column by column, as fixed width fields (see
+   Pickett et al. 1998 for the format).
+
+   Arguments:
+   rows     -- rows of the file (bytes)
+   species  -- the species name
+   origin   -- the origin of the lines
+   name     -- the database name, used as dbsource
+   q300     -- the partition function at 300 K
+   energy   -- maximum upper level energy in K (default -1, i.e. no
+               selection)
+   einstein -- minimum Einstein coefficient (default -1, i.e. no
+               selection)
+
+   Returns a structured array of lines (see line.dtype).
+
+   """
+
+   n = len(rows)
+   chars = numpy.array(rows)
+   width = max(chars.itemsize, 79)
+   chars = chars.astype("S%d" % width).view("S1").reshape(n, width)
+
+   def field(start, stop):
+      return numpy.ascontiguousarray(chars[:, start:stop]).view("S%d" % (stop - start)).ravel()
+
+   def text(start, stop):
+      column = numpy.char.strip(field(start, stop))
+      return column.astype("U")
+
+   freq = field(0, 13).astype(float) # MHz
+   errfreq = field(13, 21).astype(float) # MHz
+   intensity = 10**field(21, 29).astype(float) # nm2 MHz
+   lower_level_energy = field(31, 41).astype(float) # cm-1
+   upper_level_statistical_weight = decode_int(field(41, 44))
+
+   lines = numpy.zeros(n, dtype=line.dtype)
+   line.set_strings(lines, 'species', species)
+   lines['frequency'] = freq
+   lines['uncertainty'] = errfreq
+   lines['einstein_coefficient'] = einstein_coefficients(intensity, freq, lower_level_energy,
+                                                         upper_level_statistical_weight, q300)
+   lines['upper_level_energy'] = (lower_level_energy + freq * 1e6 / (speed_of_light * 1e2)) * cm_K # K
+   lines['upper_level_statistical_weight'] = upper_level_statistical_weight
+   line.set_strings(lines, 'upper_level_quantum_numbers', text(55, 67))
+   lines['lower_level_energy'] = lower_level_energy * cm_K # K
+   lines['lower_level_statistical_weight'] = upper_level_statistical_weight
+   line.set_strings(lines, 'lower_level_quantum_numbers', text(67, 79))
+   line.set_strings(lines, 'origin', origin)
+   line.set_strings(lines, 'dbsource', name)
+
+   # filter by einstein coefficient and energy, if required
+   valid = numpy.ones(n, dtype=bool)
+   if einstein > 0:
+      valid &= lines['einstein_coefficient'] >= einstein
+   if energy > 0:
+      valid &= lines['upper_level_energy'] <= energy
+
+   return lines[valid]
@@ -5,16 +5,37 @@ import urllib.request, urllib.parse, urllib.error
 import urllib.request, urllib.error, urllib.parse
 import urllib.parse
 import math
+import json
+import threading
+import time
+import numpy
 from . import db
 from . import line
+from . import httppool
 from .consts import *
 from datetime import datetime
 
 partfunc_url = "https://cdms.astro.uni-koeln.de/classic/entries/partition_function.html"
 maxFreqGHz = 2000
 
+# Temperatures of the columns of the partition function file
+partfunc_temperatures = [1000., 500., 300., 225., 150., 75., 37.5, 18.75, 9.375]
+# Parsed partition function table, kept on disk for partfunc_max_age seconds
+partfunc_file = "~/.gag/scratch/cdms_partfunc.json"
+partfunc_max_age = 30 * 86400.
+
+partfuncsCached = None
+partfuncLock = threading.Lock()
+# Incremented when the table is reloaded, so that partition functions
+# computed from the previous table can be dropped
+partfuncVersion = 0
+
 class Cdms(db.Db):
-   def __post(self, fmin, fmax, species, energy, einstein):
+   # Persistent HTTP connections, shared by all the instances (see
+   # httppool.Pool)
+   pool = httppool.default
+
+   def __query(self, fmin, fmax, species):
       """
       Search lines in a the CDMS database using HTTP/POST method
 
@@ -22,12 +43,11 @@ class Cdms(db.Db):
       fmin   -- the minimum frequency in MHz
       fmax   -- the maximum frequency in MHz
       species -- the species name (default All)
-      Eu_max -- maximum upper level energy expressed
-              in cm-1 (default None)
 
-      """
+      Returns the HTTP response holding the results, which is left
+      unread.
 
-      lines = []
+      """
 
       # Make a HTTP/POST query on the server. Results of the query are
       # stored in a cache file, so the request is a two step process:
@@ -60,8 +80,7 @@ class Cdms(db.Db):
 
          data = urllib.parse.urlencode(form_values)
          bdata = data.encode('utf-8')
-         req = urllib.request.Request(self.url, bdata)
-         response = urllib.request.urlopen(req, timeout = db.timeout)
+         response = self.pool.request(self.url, bdata, timeout = db.timeout)
 
          resp = response.read().decode('utf-8')
          base_url = urllib.parse.urlsplit(self.url).scheme + "://" \
@@ -69,75 +88,48 @@ class Cdms(db.Db):
          cache_url = base_url \
             + resp.split("\n")[4].split('"')[1]
 
-         req = urllib.request.Request(cache_url)
-         response = urllib.request.urlopen(req, timeout = db.timeout)
+         response = self.pool.request(cache_url, timeout = db.timeout)
 
          #print 'response=',response
 
       except Exception as error:
          raise Exception("Could not connect to database: %s" % error)
 
-      # Parse the results.
-      for l in response.readlines()[10:-1]:
-         try:
-            # Note: if this decoding ever becomes a bottleneck (which I doubt),
-            # one could keep the lines as binary and do the decoding to
-            # utf-8 string only where/when necessary.
-            l = l.decode('utf-8')
-            # NB: freq and errfreq are in MHz if errfreq>0, else in cm-1
-            freq = float(l[0:13]) # MHz
-            wavelength = speed_of_light / (freq * 1e6) * 1e2 # cm
-            errfreq = float(l[13:24])  # MHz
-            einstein_coefficient = 10**float(l[24:35])
-            lower_level_energy = float(l[37:47]) * cm_K # K
-            upper_level_statistical_weight = int(l[47:50])
-            upper_level_quantum_numbers = l[61:73].split(None, 0)[0].rsplit(None, 0)[0]
-            lower_level_quantum_numbers = l[73:88].split(None, 0)[0].rsplit(None, 0)[0]
-            spec = l[88:].split(None, 0)[0].rsplit(None, 0)[0]
-
-            #print 'l=',l
-
-            # Drop the asterisk at the beginning of some species names
-            if spec[0] == "*":
-               spec = spec[1:]
-
-
-            # filter by einstein coefficient, if required
-            if einstein > 0 and einstein_coefficient < einstein:
-                  continue
-
-            sl =  line.line()
-            sl.species = spec
-            sl.frequency = freq
-            sl.err_frequency = errfreq
-            sl.einstein_coefficient = einstein_coefficient
-            sl.upper_level.energy = lower_level_energy + cm_K / wavelength # K
-
-            # filter by energy, if required
-            if energy > 0 and sl.upper_level.energy > energy:
-                  continue
-
-            sl.upper_level.statistical_weight = upper_level_statistical_weight
-            sl.upper_level.quantum_numbers = upper_level_quantum_numbers
-            sl.lower_level.energy = lower_level_energy
-            sl.lower_level.statistical_weight = upper_level_statistical_weight
-            sl.lower_level.quantum_numbers = lower_level_quantum_numbers
-            sl.origin = self.name
-            sl.dbsource = self.name
-            sl.date = datetime.utcnow().isoformat()
-
-            lines.append(sl)
-
-         except Exception as error:
-
-            # FixMe: Some species have missing entries. Ignore them
-            # for the moment.
-            continue
-#            raise Exception, "Can't parse the response from the database: %s" % error
+      return response
 
-      return lines
+   def __post(self, fmin, fmax, species, energy, einstein):
+      """
+      Search lines in a the CDMS database and parse the whole response
+      at once
+
+      Returns a structured array of lines (see line.dtype).
+
+      """
+
+      response = self.__query(fmin, fmax, species)
+      return parse_rows(response.read().splitlines()[10:-1], self.name,
+                        energy, einstein)
+
+   def __post_batches(self, fmin, fmax, species, energy, einstein, batch_size):
+      """
+      Search lines in a the CDMS database and parse the response as it
+      is read, batch_size rows at a time
+
+      Yields structured arrays of lines (see line.dtype).
 
-   def search(self, fmin, fmax, species='All', origin='All', dbsource='All', energy=-1, einstein=-1):
+      """
+
+      response = self.__query(fmin, fmax, species)
+      try:
+         for rows in read_rows(response, batch_size):
+            lines = parse_rows(rows, self.name, energy, einstein)
+            if len(lines):
+               yield lines
+      finally:
+         response.close()
+
+   def search(self, fmin, fmax, species='All', origin='All', dbsource='All', energy=-1, einstein=-1,
+              as_array=False):
       """
       Search lines in a remote cdms db
 
@@ -149,6 +141,61 @@ class Cdms(db.Db):
                  i.e. same as 'All') or 1 string element.
       Eu_max -- maximum upper level energy expressed
               in cm-1 (default None)
+      as_array -- return a structured array (see line.dtype) instead of a
+                  list of line objects
+      """
+
+      if as_array:
+         return self.search_array(fmin, fmax, species, origin, dbsource, energy, einstein)
+
+      lines = self.search_array(fmin, fmax, species, origin, dbsource, energy, einstein)
+      if lines is None:
+         return
+
+      date = datetime.utcnow().isoformat()
+      lines = line.from_array(lines)
+      for l in lines:
+         l.date = date
+
+      return lines
+
+   def search_array(self, fmin, fmax, species='All', origin='All', dbsource='All', energy=-1, einstein=-1):
+      """
+      Same as search, but returns a structured array of lines (see
+      line.dtype)
+
+      """
+
+      lspecies = self.__select(species, origin, dbsource)
+      if lspecies is None:
+         return
+
+      return self.__post(fmin, fmax, lspecies, energy, einstein)
+
+   def search_batches(self, fmin, fmax, species='All', origin='All', dbsource='All', energy=-1, einstein=-1,
+                      batch_size=50000):
+      """
+      Same as search_array, but the response of the database is parsed
+      while it is read, and lines are yielded as structured arrays of
+      at most batch_size lines. The memory used does not depend on the
+      width of the frequency range.
+
+      """
+
+      lspecies = self.__select(species, origin, dbsource)
+      if lspecies is None:
+         return
+
+      for lines in self.__post_batches(fmin, fmax, lspecies, energy, einstein, batch_size):
+         yield lines
+
+   def __select(self, species, origin, dbsource):
+      """
+      Check the selection of a search
+
+      Returns the species to ask to the database, or None if the
+      selection excludes this database.
+
       """
 
       if origin != 'All' and origin.lower() != self.name:  # Case-insensitive
@@ -169,77 +216,326 @@ class Cdms(db.Db):
       else:
         raise Exception("Unexpected kind of argument: "+repr(species))
 
-      if self.online:
-         lines = self.__post(fmin, fmax, lspecies, energy, einstein)
-      else:
+      if not self.online:
          raise Exception("Offline in cdms instance")
 
-      return lines
+      return lspecies
 
    def part_function(self, species, origin, dbsource):
       """
       Returns the partition function at different temperatures
 
-      This function fetches a text file (in the format used in the CDMS
-      database) containing the partition function of the given species
-      for different temperatures and then parse it. The file content is
-      kept in memory to avoid re-fetching if the function is called
-      several times.
+      The partition function file of the CDMS database is fetched and
+      parsed once into a table indexed by species (see partfuncs), which
+      is kept in memory and on disk.
 
       Arguments:
       species -- the species name
 
       """
 
-      global partfuncsCached
-
       if origin.lower() != self.name:  # Case-insensitive
          raise ValueError("Got %s, but want cdms as origin for partfunc in cdms" % origin)
 
       if dbsource != self.name:
          raise ValueError("Got %s, but want cdms as dbsource for partfunc in cdms" % dbsource)
 
-      temp = [1000., 500., 300., 225., 150., 75., 37.5, 18.75, 9.375]
+      temperature, partition_function = partfuncs().get(species[7:].strip(), ([], []))
+      if len(partition_function) == 0:
+         raise db.NotFoundError("No partition function found for %s." % species)
+
+      print('partition function found')
+
+      return temperature.copy(), partition_function.copy()
+
+def read_rows(response, batch_size, header=10, footer=1):
+   """
+   Read the rows of a CDMS search result incrementally
+
+   The header and footer rows are dropped. Since the number of rows is
+   not known in advance, the last footer rows read are held back until
+   more rows come.
+
+   Arguments:
+   response   -- a file-like object (e.g. an HTTP response)
+   batch_size -- the maximum number of rows per batch
+   header     -- number of rows to skip at the beginning (default 10)
+   footer     -- number of rows to skip at the end (default 1)
+
+   Yields lists of rows (bytes).
+
+   """
 
+   rows = []
+   for i, row in enumerate(response):
+      if i < header:
+         continue
+      rows.append(row.rstrip(b"\r\n"))
+      if len(rows) >= batch_size + footer:
+         yield rows[:batch_size]
+         rows = rows[batch_size:]
+   rows = rows[:len(rows) - footer]
+   if rows:
+      yield rows
+
+def parse_rows(rows, name, energy=-1, einstein=-1):
+   """
+   Parse the result of a CDMS search
+
+   The rows are parsed column by column, as fixed width fields. Rows
+   with missing or invalid entries are dropped.
+
+   Arguments:
+   rows     -- rows of the result (bytes), without header and footer
+   name     -- the database name, used as origin and dbsource
+   energy   -- maximum upper level energy in K (default -1, i.e. no
+               selection)
+   einstein -- minimum Einstein coefficient (default -1, i.e. no
+               selection)
+
+   Returns a structured array of lines (see line.dtype).
+
+   """
+
+   n = len(rows)
+   if n == 0:
+      return numpy.zeros(0, dtype=line.dtype)
+
+   chars = numpy.array(rows)
+   width = max(chars.itemsize, 89)
+   chars = chars.astype("S%d" % width).view("S1").reshape(n, width)
+   valid = numpy.ones(n, dtype=bool)
+
+   def field(start, stop=width):
+      return numpy.ascontiguousarray(chars[:, start:stop]).view("S%d" % (stop - start)).ravel()
+
+   def number(start, stop, chunk=4096):
+      column = field(start, stop)
       try:
-         partfuncsCached
-      except NameError:
-         # TODO(mpl): shouldn't partfunc_url be .encode()ed as well?
-         # -> causes problem with timeout, wtf. will investigate later.
-         #f =  urllib2.urlopen(partfunc_url.encode('utf-8'))
-         f =  urllib.request.urlopen(partfunc_url)
-         partfuncsCached = f.readlines()
-         f.close()
-
-      temperature = []
-      partition_function = []
-
-      for l in partfuncsCached:
+         return column.astype(float)
+      except ValueError:
+         pass
+      # FixMe: Some species have missing entries. Ignore them
+      # for the moment. Only the chunks with invalid entries are parsed
+      # entry by entry.
+      values = numpy.empty(n)
+      for i in range(0, n, chunk):
+         try:
+            values[i:i + chunk] = column[i:i + chunk].astype(float)
+            continue
+         except ValueError:
+            pass
+         for j in range(i, min(i + chunk, n)):
+            try:
+               values[j] = float(column[j])
+            except ValueError:
+               values[j] = numpy.nan
+               valid[j] = False
+      return values
+
+   def text(start, stop=width):
+      column = numpy.char.strip(field(start, stop))
+      valid[numpy.char.str_len(column) == 0] = False
+      try:
+         return column.astype("U")
+      except UnicodeDecodeError:
+         return numpy.char.decode(column, 'utf-8')
+
+   # NB: freq and errfreq are in MHz if errfreq>0, else in cm-1
+   freq = number(0, 13) # MHz
+   wavelength = speed_of_light / (freq * 1e6) * 1e2 # cm
+   errfreq = number(13, 24) # MHz
+   einstein_coefficient = 10.0 ** number(24, 35)
+   lower_level_energy = number(37, 47) * cm_K # K
+   upper_level_statistical_weight = number(47, 50)
+   upper_level_quantum_numbers = text(61, 73)
+   lower_level_quantum_numbers = text(73, 88)
+   spec = text(88)
+
+   # Drop the asterisk at the beginning of some species names
+   for i in numpy.flatnonzero(numpy.char.startswith(spec, "*")):
+      spec[i] = spec[i][1:]
+
+   lines = numpy.zeros(n, dtype=line.dtype)
+   line.set_strings(lines, 'species', spec)
+   lines['frequency'] = freq
+   lines['uncertainty'] = errfreq
+   lines['einstein_coefficient'] = einstein_coefficient
+   lines['upper_level_energy'] = lower_level_energy + cm_K / wavelength # K
+   lines['upper_level_statistical_weight'] = upper_level_statistical_weight
+   line.set_strings(lines, 'upper_level_quantum_numbers', upper_level_quantum_numbers)
+   lines['lower_level_energy'] = lower_level_energy
+   lines['lower_level_statistical_weight'] = upper_level_statistical_weight
+   line.set_strings(lines, 'lower_level_quantum_numbers', lower_level_quantum_numbers)
+   line.set_strings(lines, 'origin', name)
+   line.set_strings(lines, 'dbsource', name)
+
+   # filter by einstein coefficient and energy, if required
+   if einstein > 0:
+      valid &= einstein_coefficient >= einstein
+   if energy > 0:
+      valid &= lines['upper_level_energy'] <= energy
+
+   return lines[valid]
+
+def parse_partfunc(lines):
+   """
+   Parse the partition function file of the CDMS database
+
+   Arguments:
+   lines -- lines of the file (bytes or strings)
+
+   Returns a dict of (temperature, partition function) arrays indexed by
+   species name (without tag), and also by species tag (e.g. "028503").
+
+   """
+
+   table = {}
+
+   for l in lines:
+      if isinstance(l, bytes):
          l = l.decode('utf-8')
-   
-         if l[0] == "<":
+
+      if len(l) == 0 or l[0] == "<":
+         continue
+      try:
+         spec = l[7:28].strip()
+         if spec == "":
             continue
-         try:
-            spec = l[7:28].strip()
-            #print 'spec=',spec,'species=',species[7:]
-            
-            if spec == "":
+         tag = l[:6].strip()
+         tag = "%06d" % int(tag) if tag.isdigit() else None
+         field = l[40:].split()
+         temperature = []
+         partition_function = []
+         for i in range(len(partfunc_temperatures)):
+            if field[i] == "---":
                continue
-            if spec == species[7:].strip():
-               print('partition function found')
-               field = l[40:].split()
-               for i in range(len(temp)):
-                  if field[i] == "---":
-                     continue
-                  temperature.append(temp[i])
-                  partition_function.append(10**float(field[i]))
-         except:
-            continue
+            temperature.append(partfunc_temperatures[i])
+            partition_function.append(10**float(field[i]))
+      except:
+         continue
+      if spec in table:
+         # Same as several matching lines in the file
+         temperature = numpy.concatenate((table[spec][0], temperature))
+         partition_function = numpy.concatenate((table[spec][1], partition_function))
+      table[spec] = (numpy.array(temperature), numpy.array(partition_function))
+      if tag is not None:
+         table[tag] = table[spec]
+
+   return table
+
+def load_partfunc(filename):
+   """
+   Load the partition function table from a local file
+
+   The file may be either a table saved by save_partfunc, or a copy of
+   the partition function file of the CDMS database, which allows to
+   work offline. The table is then used by all Cdms instances.
+
+   Arguments:
+   filename -- the file name
+
+   Returns the table (see parse_partfunc).
+
+   """
+
+   global partfuncsCached, partfuncVersion
+
+   filename = os.path.expanduser(filename)
+   with open(filename, 'rb') as f:
+      content = f.read()
+
+   try:
+      saved = json.loads(content.decode('utf-8'))
+      table = dict((spec, (numpy.array(t), numpy.array(q)))
+                   for spec, (t, q) in saved["partfuncs"].items())
+   except ValueError:
+      table = parse_partfunc(content.splitlines())
+
+   with partfuncLock:
+      partfuncsCached = table
+      partfuncVersion += 1
+
+   return table
+
+def save_partfunc(filename, table):
+   """
+   Save the partition function table to a file, with the current date
+
+   Arguments:
+   filename -- the file name
+   table    -- the table (see parse_partfunc)
+
+   """
+
+   filename = os.path.expanduser(filename)
+   saved = {"date": time.time(),
+            "url": partfunc_url,
+            "partfuncs": dict((spec, (list(t), list(q)))
+                              for spec, (t, q) in table.items())}
+   directory = os.path.dirname(filename)
+   if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+   # Write to a temporary file first, so that other processes never
+   # read a partial table.
+   tmp = "%s.%d" % (filename, os.getpid())
+   with open(tmp, 'w') as f:
+      json.dump(saved, f)
+   os.replace(tmp, filename)
+
+def partfuncs(download=True):
+   """
+   Returns the partition function table of the CDMS database
+
+   The table is read from partfunc_file if it is less than
+   partfunc_max_age seconds old. Otherwise the partition function file
+   is fetched, parsed, and saved to partfunc_file. In both cases it is
+   then kept in memory.
+
+   Arguments:
+   download -- fetch the partition function file if needed (default
+               True). If False, the table is only taken from memory or
+               from partfunc_file, whatever its age, and None is
+               returned if there is none.
+
+   """
+
+   global partfuncsCached
+
+   with partfuncLock:
+      if partfuncsCached is not None:
+         return partfuncsCached
+
+      filename = os.path.expanduser(partfunc_file)
+      try:
+         with open(filename) as f:
+            saved = json.load(f)
+         if (not download or time.time() - saved["date"] < partfunc_max_age) \
+            and saved.get("url") == partfunc_url:
+            partfuncsCached = dict((spec, (numpy.array(t), numpy.array(q)))
+                                   for spec, (t, q) in saved["partfuncs"].items())
+            return partfuncsCached
+      except (IOError, ValueError, KeyError):
+         pass
+
+      if not download:
+         return None
+
+      # TODO(mpl): shouldn't partfunc_url be .encode()ed as well?
+      # -> causes problem with timeout, wtf. will investigate later.
+      #f =  urllib2.urlopen(partfunc_url.encode('utf-8'))
+      f = httppool.default.request(partfunc_url, timeout = db.timeout)
+      table = parse_partfunc(f.readlines())
+      f.close()
 
-      if partition_function == []:
-         raise db.NotFoundError("No partition function found for %s." % species)
+      try:
+         save_partfunc(filename, table)
+      except (IOError, OSError):
+         # Not being able to keep the table is not an error
+         pass
 
-      return temperature, partition_function
+      partfuncsCached = table
+      return partfuncsCached
 
 default = Cdms(url = "https://cdms.astro.uni-koeln.de/cgi-bin/cdmssearch",
           cache_file = "~/.gag/scratch/cdms.db", protocol = "cdms_post",
@@ -6,8 +6,18 @@ from . import cache
 NotFoundError = cache.NotFoundError
 blankPartfunc = cache.blankPartfunc
 origins = cache.origins
+merge_windows = cache.merge_windows
+split_windows = cache.split_windows
 timeout = 60
 dbVersion = "1.00"
+# Windows less than windowGap MHz apart (about a line width) are fetched
+# with a single query by search_windows, so that only the lines of the
+# windows are fetched. Callers may give a larger gap to make fewer
+# queries.
+windowGap = 5.
+# Maximum width in MHz of the merged windows. The CDMS fails on queries
+# of a few GHz (see cdms.Cdms), so windows are not merged beyond that.
+windowMaxWidth = 2000.
 
 class Db:
    """
@@ -28,7 +38,7 @@ class Db:
 
       This function create a database instance which is accessed
       through a given protocol. Supported protocols are "slap",
-      "cdms_post" and "jpl_post".
+      "cdms_post", "jpl_post", "catfile", "local" and "federated".
 
       Arguments:
       url       -- The URL of the database
@@ -40,7 +50,7 @@ class Db:
 
       """
 
-      if not protocol in ["slap", "cdms_post", "jpl_post", "catfile", "local"]:
+      if not protocol in ["slap", "cdms_post", "jpl_post", "catfile", "local", "federated"]:
          raise ValueError("Unknown protocol")
       if online:
          if protocol in ["catfile", "local"]:
@@ -48,7 +58,7 @@ class Db:
          #else:
             # Should try a request to see whether it is available
       else:
-         if not protocol in ["catfile", "local"] and not isDbFile(cache_file):
+         if not protocol in ["catfile", "local", "federated"] and not cache.isDbFile(cache_file):
             raise ValueError("Offline cache not available")
 
       class linedb_data_class():
@@ -63,3 +73,112 @@ class Db:
       self.online = online
       self.data = linedb_data_class()
       self.name = name
+
+   def search_windows(self, windows, species='All', origin='All', dbsource='All', energy=-1, einstein=-1,
+                      as_array=False, gap=None, max_width=None):
+      """
+      Search lines in several frequency windows
+
+      Windows that overlap or are less than gap apart (default
+      windowGap) are merged, so that the database is queried once per
+      merged window instead of once per window, as long as merged
+      windows are at most max_width wide (default windowMaxWidth). The
+      lines found are then split back between the windows.
+
+      Arguments:
+      windows   -- list of (fmin, fmax) windows, in MHz
+      gap       -- the maximum distance in MHz between merged windows
+      max_width -- the maximum width in MHz of merged windows
+
+      Other arguments are the same as for search. Returns a list of
+      lines per window.
+
+      """
+
+      if gap is None:
+         gap = windowGap
+      if max_width is None:
+         max_width = windowMaxWidth
+
+      return cache.search_windows(self, windows, gap, species=species, origin=origin,
+                                  dbsource=dbsource, energy=energy, einstein=einstein,
+                                  as_array=as_array, max_width=max_width)
+
+class Local(Db):
+   """
+   Line database stored in a local SQLite file
+
+   The file is a cache of a line database (see cache.Cache), e.g. one
+   that has been filled from CDMS. Searches are made through a single
+   Cache instance, whose connections are kept open between searches.
+
+   """
+
+   def __init__(self, cache_file, url = "", protocol = "local", online = False,
+             name = "local", concurrent = False):
+      """
+      Arguments:
+      cache_file -- the name of the SQLite file
+      url        -- not used
+      protocol   -- the database protocol (must be "local")
+      online     -- must be False
+      name       -- the name of the database (default "local")
+      concurrent -- open the cache for concurrent access (see cache.Cache)
+
+      """
+
+      Db.__init__(self, url, cache_file, protocol, online, name)
+
+      if not os.path.isfile(self.cache_file) or not cache.isDbFile(self.cache_file):
+         raise ValueError("Database file {0} not available".format(self.cache_file))
+
+      self.cache = cache.Cache(self.cache_file, concurrent = concurrent)
+
+   def close(self):
+      """
+      Close the connections to the SQLite file
+
+      """
+
+      self.cache.close()
+
+   def __species(self, species):
+      # The species names of lines fetched from a remote database may
+      # differ from the name used in the query (e.g. CDMS drops the
+      # species tag), so queries are translated when they are known (see
+      # cache.Cache.query_species).
+      if type(species) == str and species != 'All':
+         return self.cache.query_species(species) or species
+      return species
+
+   def search(self, fmin, fmax, species='All', origin='All', dbsource='All', energy=-1, einstein=-1,
+              as_array=False):
+      """
+      Search lines in the local database (see cache.Cache.search)
+
+      """
+
+      return self.cache.search(fmin, fmax, self.__species(species), origin, dbsource,
+                               energy, einstein, as_array)
+
+   def search_array(self, fmin, fmax, species='All', origin='All', dbsource='All', energy=-1, einstein=-1):
+      """
+      Same as search, but returns a structured array of lines (see
+      line.dtype)
+
+      """
+
+      return self.cache.search_array(fmin, fmax, self.__species(species), origin, dbsource,
+                                     energy, einstein)
+
+   def part_function(self, species, origin, dbsource):
+      """
+      Returns the partition function at different temperatures (see
+      cache.Cache.partition_function)
+
+      Arguments:
+      species -- the species name
+
+      """
+
+      return self.cache.partition_function(species, origin, dbsource)
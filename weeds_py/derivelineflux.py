@@ -11,13 +11,17 @@ import matplotlib.pyplot as plt
 
 
 
-def CalculateLineFlux(para,lines = None, fwhm = None ,part=None):
+def CalculateLineFlux(para,lines = None, fwhm = None ,part=None, templates=None):
     
     """calculate line fluxes of a given list of lines
          para: N_tot (cm^-2), Tex (K)
          lines:spectral information list from cdmsobject.search
          fwhm: a list of fwhm in km/s
          part: partion function from cdmsobject.part_function
+         templates: optional modsource.OpacityTemplates instance. The
+                    opacity of each line is then computed for a unit
+                    column density and cached, so that calls that only
+                    change N_tot skip the opacity computation.
          
          Output:
          an numpy array of line flux in unit of K. km/s
@@ -25,8 +29,7 @@ def CalculateLineFlux(para,lines = None, fwhm = None ,part=None):
     
     ntot = para[0]
     tex  = para[1]
-    f_dum  = interp1d(log(part[0]),log(part[1]))
-    partitionfunc = exp(f_dum(log(tex)))
+    partitionfunc = None # only needed when a template is computed
     
     nline = len(lines)
     line_flux = zeros(nline)
@@ -34,23 +37,42 @@ def CalculateLineFlux(para,lines = None, fwhm = None ,part=None):
     
     for i in range(nline):
         l = lines[i][0]
-        freq_fwhm = fwhm[i]*1e3/speed_of_light*l.frequency
+
+        def LineTemplate(l=l, i=i):
+            """opacity of a line for N_tot = 1 cm^-2, on its own grid"""
+            nonlocal partitionfunc
+            if partitionfunc is None:
+                f_dum = modsource.partition_functions.get(
+                    ('part', tuple(part[0]), tuple(part[1])),
+                    lambda: modsource.partition_interpolator(part[0], part[1]))
+                partitionfunc = f_dum(tex)
+
+            freq_fwhm = fwhm[i]*1e3/speed_of_light*l.frequency
         
-        freq = arange(l.frequency-2.*freq_fwhm,l.frequency+2.*freq_fwhm,freq_fwhm/20.)
-        v_kms_grid = (freq-l.frequency)/l.frequency*speed_of_light*1e-3
+            freq = arange(l.frequency-2.*freq_fwhm,l.frequency+2.*freq_fwhm,freq_fwhm/20.)
+            v_kms_grid = (freq-l.frequency)/l.frequency*speed_of_light*1e-3
         
-        sigma = l.frequency / (speed_of_light * sqrt(8 * log(2))) \
-                * fwhm[i] * 1e3 * 1e6 # Hz
+            sigma = l.frequency / (speed_of_light * sqrt(8 * log(2))) \
+                    * fwhm[i] * 1e3 * 1e6 # Hz
             
-        phi = 1 / (sigma * sqrt(2 * pi)) * exp (-((freq - l.frequency) \
-                                                          * 1e6)**2 / (2 * sigma**2))
-                        # Line opacity
-        tau = speed_of_light**2 / (8 * pi * (freq * 1e6)**2) * l.einstein_coefficient \
-                      * ntot * 1e4 * l.upper_level.statistical_weight \
-                      * exp(-l.upper_level.energy / tex) \
-                      / partitionfunc * (exp(planck_constant * l.frequency * 1e6 \
-                                                                 / (tex * boltzmann_constant))-1) * phi
-        tb = J(tex, freq)*(1.-exp(-1.*tau)) # assumed no beam dilution
+            phi = 1 / (sigma * sqrt(2 * pi)) * exp (-((freq - l.frequency) \
+                                                              * 1e6)**2 / (2 * sigma**2))
+                            # Line opacity
+            tau = speed_of_light**2 / (8 * pi * (freq * 1e6)**2) * l.einstein_coefficient \
+                          * 1e4 * l.upper_level.statistical_weight \
+                          * exp(-l.upper_level.energy / tex) \
+                          / partitionfunc * (exp(planck_constant * l.frequency * 1e6 \
+                                                                     / (tex * boltzmann_constant))-1) * phi
+            return v_kms_grid, J(tex, freq), tau
+
+        if templates is None:
+            v_kms_grid, jtex, tau = LineTemplate()
+        else:
+            key = ('lineflux', l.species, l.frequency, l.upper_level.quantum_numbers,
+                   l.lower_level.quantum_numbers, tex, fwhm[i])
+            v_kms_grid, jtex, tau = templates.get(key, LineTemplate)
+
+        tb = jtex*(1.-exp(-1.*ntot*tau)) # assumed no beam dilution
         #plt.plot(v_kms_grid,tb)
                     
         line_flux[i] = simps(tb,v_kms_grid)
@@ -76,16 +98,18 @@ def NtotTexFittingFunc(data,species_ind=48501,species = '048501 SO, v=0',\
           online = True, name = "cdms")
     part = cdmsobject.part_function(species,'cdms','cdms')
     
-    lines = []
-    for ifreq in freq:
-        dummy = cdmsobject.search(ifreq-0.5,ifreq+0.5,species=species,origin='All')
-    
-        lines.append(dummy)
+    # one query for nearby observed lines of the species (see
+    # db.Db.search_windows)
+    windows = [(ifreq-0.5,ifreq+0.5) for ifreq in freq]
+    lines = cdmsobject.search_windows(windows,species=species,origin='All')
+
+    # unit column density opacities, reused while only ntot changes
+    templates = modsource.OpacityTemplates(maxsize=4*len(lines))
 
     # a wrapper function
     def mixCalculateLineFlux(x,ntot,tex):
         para = [ntot,tex]
-        y = CalculateLineFlux(para,lines=lines,fwhm=fwhm,part=part)
+        y = CalculateLineFlux(para,lines=lines,fwhm=fwhm,part=part,templates=templates)
     return y
 
     popt, pcov = optimization.curve_fit(mixCalculateLineFlux, x, flux,sigma=ef,p0=p0)
@@ -0,0 +1,231 @@
+# federated.py -- linedb implementation searching several databases at once
+
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+from . import db
+from . import line
+
+# Columns identifying a line in de-duplication. Species names are
+# compared without their tag (see species_name).
+lineKey = ["species", "upper_level_quantum_numbers", "lower_level_quantum_numbers"]
+
+class Federated(db.Db):
+   """
+   Line database made of several databases
+
+   A search is made in all the databases at once, each one in its own
+   thread, and the results are merged. Lines found in several databases
+   (i.e. with the same species and upper and lower level quantum
+   numbers) are only kept from the database with the highest priority.
+   Species are compared without their tag, since databases do not name
+   them in the same way (e.g. "CO" in the CDMS and "028503 CO" in a
+   catalog file).
+   Partition functions are taken from the first database, in priority
+   order, that has them.
+
+   """
+
+   def __init__(self, databases, priority=None, name="federated"):
+      """
+      Arguments:
+      databases -- list of databases (e.g. db.Local, catfile.Catfile or
+                   cdms.Cdms instances)
+      priority  -- list of database names, from the highest to the lowest
+                   priority (default the order of databases)
+      name      -- the name of the database (default "federated")
+
+      """
+
+      db.Db.__init__(self, "", "", "federated", False, name)
+
+      if priority is not None:
+         names = [d.name for d in databases]
+         for n in priority:
+            if not n in names:
+               raise ValueError("Unknown database %s in priority" % n)
+         databases = sorted(databases, key=lambda d: priority.index(d.name)
+                            if d.name in priority else len(priority))
+      self.databases = list(databases)
+      self.online = any(getattr(d, "online", False) for d in self.databases)
+      # Threads are kept between searches, so that databases that keep
+      # one connection per thread (see cache.Cache) can reuse them.
+      self.pool = ThreadPoolExecutor(max_workers=max(1, len(self.databases)))
+
+   def close(self):
+      """
+      Stop the search threads
+
+      """
+
+      self.pool.shutdown()
+
+   def search(self, fmin, fmax, species='All', origin='All', dbsource='All', energy=-1, einstein=-1,
+              as_array=False):
+      """
+      Search lines in all the databases
+
+      Arguments:
+      fmin   -- the minimum frequency in MHz
+      fmax   -- the maximum frequency in MHz
+      species -- the species name
+      energy -- maximum upper level energy expressed
+              in Kelvins (default -1)
+      einstein -- minimum Einstein coefficient (default -1)
+      as_array -- return a structured array (see line.dtype) instead of a
+                  list of line objects
+
+      """
+
+      lines = self.search_array(fmin, fmax, species, origin, dbsource, energy, einstein)
+      if as_array or lines is None:
+         return lines
+
+      return line.from_array(lines)
+
+   def search_array(self, fmin, fmax, species='All', origin='All', dbsource='All', energy=-1, einstein=-1):
+      """
+      Same as search, but returns a structured array of lines (see
+      line.dtype), sorted by frequency
+
+      """
+
+      def search(database):
+         return database.search_array(fmin, fmax, species=species, origin=origin,
+                                      dbsource=dbsource, energy=energy, einstein=einstein)
+
+      futures = [self.pool.submit(search, d) for d in self.databases]
+
+      found = []
+      errors = []
+      for d, future in zip(self.databases, futures):
+         try:
+            found.append(future.result())
+         except Exception as error:
+            print("Search failed in %s: %s" % (d.name, error))
+            errors.append(error)
+            found.append(None)
+      if errors and len(errors) == len(self.databases):
+         raise errors[0]
+
+      if all(lines is None for lines in found):
+         return
+
+      # All the lines found for a single species are of that species,
+      # whatever their name in each database. This does not hold for
+      # wildcard species (e.g. "032504* *CH3OH, vt=0,1" in the cache).
+      if type(species) == str and species != 'All' \
+            and not '*' in species and not '%' in species:
+         return merge(found, species)
+      return merge(found)
+
+   def part_function(self, species, origin, dbsource):
+      """
+      Returns the partition function at different temperatures, from
+      the first database that has it
+
+      Arguments:
+      species -- the species name
+
+      """
+
+      for d in self.databases:
+         try:
+            return d.part_function(species, origin, dbsource)
+         except (db.NotFoundError, ValueError):
+            continue
+
+      raise db.NotFoundError("No partition function found for %s." % species)
+
+def species_name(species):
+   """
+   Returns a species name without its tag
+
+   E.g. "CO" for "028503 CO". A name that is only a tag is kept as is.
+
+   Arguments:
+   species -- the species name
+
+   """
+
+   if len(species) > 7 and species[:6].isdigit() and species[6] == " ":
+      return species[7:].strip()
+   return species
+
+def char_codes(column):
+   """
+   Returns the characters of a string column, as a (n, width) array of
+   character codes without the padding that is not used by any string
+
+   """
+
+   n = len(column)
+   chars = numpy.ascontiguousarray(column).view(numpy.uint32).reshape(n, -1)
+   used = numpy.flatnonzero(chars.any(axis=0))
+   return chars[:, :used[-1] + 1 if len(used) else 1]
+
+def void_key(codes):
+   """
+   Returns the rows of a 2D array as opaque values, that can be
+   compared and sorted at once
+
+   """
+
+   codes = numpy.ascontiguousarray(codes)
+   return codes.view("V%d" % (codes.shape[1] * codes.itemsize)).ravel()
+
+def merge(found, species=None):
+   """
+   Merge the lines found in several databases
+
+   A line found in several databases (see lineKey) is only kept from
+   the first one. Lines of a single database are all kept.
+
+   Arguments:
+   found   -- list of structured arrays of lines (see line.dtype), from
+              the highest to the lowest priority database. None entries
+              are ignored.
+   species -- the species of all the lines, if they were searched for a
+              single species (default None, i.e. from the lines). Their
+              names are then not compared.
+
+   Returns a structured array of lines sorted by frequency.
+
+   """
+
+   found = [lines for lines in found if lines is not None]
+   if len(found) == 0:
+      return numpy.zeros(0, dtype=line.dtype)
+
+   lines = numpy.concatenate(found)
+   rank = numpy.repeat(numpy.arange(len(found)), [len(lines) for lines in found])
+   if len(lines) == 0:
+      return lines
+
+   # Rank of the first database where each line is found. Lines are
+   # compared on the characters of their key (4 bytes each), without the
+   # padding that is not used by any line, which is much faster than
+   # comparing the strings.
+   n = len(lines)
+   keys = []
+   for k in lineKey:
+      keys.append(char_codes(lines[k]))
+
+   # Species are replaced by the code of their name without tag
+   unique, first, inverse = numpy.unique(void_key(keys[0]), return_index=True,
+                                         return_inverse=True)
+   if species is None:
+      names = [species_name(name) for name in lines["species"][first].tolist()]
+   else:
+      names = [species_name(species)] * len(unique)
+   names, code = numpy.unique(names, return_inverse=True)
+   keys[0] = code.ravel()[inverse.ravel()].astype(numpy.uint32).reshape(n, 1)
+
+   codes = numpy.ascontiguousarray(numpy.hstack(keys))
+   key = void_key(codes)
+   unique, inverse = numpy.unique(key, return_inverse=True)
+   best = numpy.full(len(unique), len(found))
+   numpy.minimum.at(best, inverse, rank)
+   kept = numpy.flatnonzero(rank == best[inverse])
+
+   # Lines are copied only once
+   return lines[kept[numpy.argsort(lines["frequency"][kept], kind="stable")]]
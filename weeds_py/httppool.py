@@ -0,0 +1,330 @@
+# httppool.py -- Persistent HTTP connections for the online databases
+
+import base64
+import http.client
+import select
+import threading
+import urllib.parse
+import urllib.request
+
+# Maximum number of idle connections kept per host
+maxIdle = 8
+# Maximum number of redirections followed by a request
+maxRedirects = 5
+
+# Methods of the requests that are sent again when a reused connection
+# turns out to be closed
+idempotentMethods = ("GET", "HEAD")
+
+class HTTPError(Exception):
+   pass
+
+def dropped(connection):
+   """
+   Whether an idle connection has been closed by the server
+
+   An idle connection has nothing to read, unless the server has closed
+   it (or sent unexpected data, which makes it unusable as well).
+
+   """
+
+   if connection.sock is None:
+      return False
+   try:
+      readable, _, _ = select.select([connection.sock], [], [], 0)
+   except (OSError, ValueError):
+      return True
+   return bool(readable)
+
+class Pool:
+   """
+   Pool of persistent HTTP(S) connections
+
+   Connections are kept alive and reused by the following requests to
+   the same host, so that the TCP connection and TLS handshake are
+   only made once per session instead of once per request. The pool
+   can be shared between threads: each request takes an idle
+   connection, or opens a new one, and gives it back once the
+   response has been read.
+
+   Proxies are taken from the environment (e.g. HTTP_PROXY,
+   HTTPS_PROXY and NO_PROXY, see urllib.request.getproxies), as
+   urllib.request.urlopen does: HTTP requests are sent to the proxy,
+   and HTTPS connections are tunnelled through it.
+
+   The number of requests, of connections opened and of connections
+   reused are counted in the stats dictionary.
+
+   """
+
+   def __init__(self, timeout=60, max_idle=maxIdle, proxies=None):
+      """
+      Arguments:
+      timeout  -- the connection timeout in seconds
+      max_idle -- maximum number of idle connections kept per host
+      proxies  -- dictionary of proxy URLs indexed by scheme (default
+                  from the environment, see urllib.request.getproxies)
+
+      """
+
+      self.timeout = timeout
+      self.max_idle = max_idle
+      self.proxies = proxies
+      self.idle = {}
+      self.lock = threading.Lock()
+      self.stats = {"requests": 0, "connections": 0, "reused": 0,
+                    "retries": 0}
+
+   def __count(self, key):
+      with self.lock:
+         self.stats[key] += 1
+
+   def proxy(self, host):
+      """
+      Returns the URL of the proxy to use for a host, or None
+
+      Arguments:
+      host -- (scheme, netloc) tuple
+
+      """
+
+      scheme, netloc = host
+      proxies = self.proxies
+      if proxies is None:
+         proxies = urllib.request.getproxies()
+         hostname = urllib.parse.urlsplit("//" + netloc).hostname or netloc
+         if proxies and urllib.request.proxy_bypass(hostname):
+            return None
+      return proxies.get(scheme)
+
+   def __acquire(self, host, timeout):
+      # Returns an idle connection to host, a (scheme, netloc, proxy)
+      # tuple, or a new one, and whether it is reused
+      while True:
+         with self.lock:
+            idle = self.idle.get(host)
+            connection = idle.pop() if idle else None
+         if connection is None or not dropped(connection):
+            break
+         # Closed by the server while it was idle
+         connection.close()
+      self.__count("reused" if connection is not None else "connections")
+
+      if connection is not None:
+         # The connection may have been opened with another timeout
+         connection.timeout = timeout
+         if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+         return connection, True
+
+      scheme, netloc, proxy = host
+      if proxy is None:
+         if scheme == "https":
+            connection = http.client.HTTPSConnection(netloc, timeout=timeout)
+         else:
+            connection = http.client.HTTPConnection(netloc, timeout=timeout)
+         return connection, False
+
+      if "://" not in proxy:
+         proxy = "http://" + proxy
+      split = urllib.parse.urlsplit(proxy)
+      address = split.hostname
+      if split.port is not None:
+         address = "%s:%d" % (address, split.port)
+      # HTTPS connections are opened with the proxy, and then tunnelled
+      # to the host, as urllib does
+      if scheme == "https":
+         connection = http.client.HTTPSConnection(address, timeout=timeout)
+      else:
+         connection = http.client.HTTPConnection(address, timeout=timeout)
+      headers = {}
+      if split.username is not None:
+         credentials = "%s:%s" % (urllib.parse.unquote(split.username),
+                                  urllib.parse.unquote(split.password or ""))
+         headers["Proxy-Authorization"] = "Basic " \
+            + base64.b64encode(credentials.encode()).decode("ascii")
+      if scheme == "https":
+         connection.set_tunnel(netloc, headers=headers)
+      else:
+         # Requests are sent to the proxy with the full URL
+         connection.proxy_headers = headers
+      return connection, False
+
+   def release(self, host, connection):
+      """
+      Give a connection back to the pool
+
+      The connection is closed if too many are idle already.
+
+      """
+
+      with self.lock:
+         idle = self.idle.setdefault(host, [])
+         if len(idle) < self.max_idle:
+            idle.append(connection)
+            return
+      connection.close()
+
+   def close(self):
+      """
+      Close all the idle connections
+
+      """
+
+      with self.lock:
+         idle = self.idle
+         self.idle = {}
+      for connections in idle.values():
+         for connection in connections:
+            connection.close()
+
+   def request(self, url, data=None, headers=None, timeout=None):
+      """
+      Make a HTTP request
+
+      A POST request is made if data is given, and a GET request
+      otherwise. Redirections are followed.
+
+      Arguments:
+      url     -- the URL
+      data    -- the body of a POST request (bytes), e.g. an encoded form
+      headers -- additional headers
+      timeout -- the timeout in seconds (default self.timeout)
+
+      Returns a Response, which must be read or closed so that the
+      connection can be reused.
+
+      """
+
+      if timeout is None:
+         timeout = self.timeout
+
+      for i in range(maxRedirects + 1):
+         response = self.__request(url, data, headers, timeout)
+         if response.status in (301, 302, 303, 307, 308):
+            location = response.getheader("Location")
+            response.read()
+            response.close()
+            if location is None:
+               raise HTTPError("Redirection without location from %s" % url)
+            url = urllib.parse.urljoin(url, location)
+            if response.status != 307 and response.status != 308:
+               data = None
+            continue
+         if response.status >= 400:
+            response.close()
+            raise HTTPError("HTTP Error %d: %s" % (response.status, response.reason))
+         return response
+
+      raise HTTPError("Too many redirections from %s" % url)
+
+   def __request(self, url, data, headers, timeout):
+      split = urllib.parse.urlsplit(url)
+      proxy = self.proxy((split.scheme, split.netloc))
+      host = (split.scheme, split.netloc, proxy)
+      path = split.path or "/"
+      if split.query:
+         path += "?" + split.query
+      if proxy is not None and split.scheme != "https":
+         path = "%s://%s%s" % (split.scheme, split.netloc, path)
+
+      allheaders = {"Connection": "keep-alive"}
+      if data is not None:
+         allheaders["Content-Type"] = "application/x-www-form-urlencoded"
+      if headers:
+         allheaders.update(headers)
+
+      method = "GET" if data is None else "POST"
+
+      self.__count("requests")
+      while True:
+         connection, reused = self.__acquire(host, timeout)
+         sent = False
+         try:
+            requestheaders = allheaders
+            if getattr(connection, "proxy_headers", None):
+               requestheaders = dict(allheaders, **connection.proxy_headers)
+            connection.request(method, path, body=data, headers=requestheaders)
+            sent = True
+            response = connection.getresponse()
+         except (ConnectionError, http.client.BadStatusLine):
+            connection.close()
+            if reused and (method in idempotentMethods or not sent):
+               # The server closed the idle connection, try again with
+               # another one. Other requests may have been processed by
+               # the server, so they are not sent again.
+               self.__count("retries")
+               continue
+            raise
+         except Exception:
+            connection.close()
+            raise
+         return Response(self, host, connection, response)
+
+class Response:
+   """
+   HTTP response of a pooled connection
+
+   The connection goes back to the pool as soon as the whole response
+   has been read, or when the response is closed.
+
+   """
+
+   def __init__(self, pool, host, connection, response):
+      self.pool = pool
+      self.host = host
+      self.connection = connection
+      self.response = response
+      self.status = response.status
+      self.reason = response.reason
+
+   def getheader(self, name, default=None):
+      return self.response.getheader(name, default)
+
+   def __done(self):
+      # Release the connection once the response has been read
+      if self.connection is not None and self.response.isclosed():
+         connection = self.connection
+         self.connection = None
+         if self.response.will_close:
+            connection.close()
+         else:
+            self.pool.release(self.host, connection)
+
+   def read(self, amt=None):
+      data = self.response.read(amt)
+      self.__done()
+      return data
+
+   def readline(self):
+      data = self.response.readline()
+      if not data:
+         self.__done()
+      return data
+
+   def readlines(self):
+      return self.read().splitlines(True)
+
+   def __iter__(self):
+      while True:
+         data = self.readline()
+         if not data:
+            return
+         yield data
+
+   def close(self):
+      self.__done()
+      if self.connection is not None:
+         # Unread data: the connection cannot be reused
+         self.connection.close()
+         self.connection = None
+      self.response.close()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, exc_type, exc_value, traceback):
+      self.close()
+
+# Pool shared by the online databases
+default = Pool()
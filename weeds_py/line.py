@@ -1,5 +1,30 @@
 # line.py -- Classes and methods for spectral lines
 
+import numpy
+
+# Structured array type for columnar line lists. Field names are those of
+# the line table of the cache. Strings that do not fit in their field
+# are an error (see array and set_strings), not truncated.
+dtype = numpy.dtype([("species", "U64"),
+                     ("frequency", "f8"),
+                     ("uncertainty", "f8"),
+                     ("einstein_coefficient", "f8"),
+                     ("upper_level_energy", "f8"),
+                     ("upper_level_statistical_weight", "f8"),
+                     ("upper_level_quantum_numbers", "U64"),
+                     ("lower_level_energy", "f8"),
+                     ("lower_level_statistical_weight", "f8"),
+                     ("lower_level_quantum_numbers", "U64"),
+                     ("origin", "U64"),
+                     ("dbsource", "U64")])
+
+# String fields of dtype, with their width in characters
+stringFields = dict((name, dtype[name].itemsize // 4) for name in dtype.names
+                    if dtype[name].kind == "U")
+
+class TruncationError(ValueError):
+   pass
+
 class line:
    """
    Spectral line
@@ -34,6 +59,99 @@ class level:
       self.statistical_weight = 0.
       self.quantum_numbers = ''
 
+def to_array(lines):
+   """
+   Convert a list of line objects to a structured array (see dtype)
+
+   Arguments:
+   lines -- list of line objects
+
+   """
+
+   return array([(l.species, l.frequency, l.err_frequency,
+                  l.einstein_coefficient, l.upper_level.energy,
+                  l.upper_level.statistical_weight,
+                  l.upper_level.quantum_numbers, l.lower_level.energy,
+                  l.lower_level.statistical_weight,
+                  l.lower_level.quantum_numbers, l.origin,
+                  l.dbsource or l.prev) for l in lines])
+
+def array(rows):
+   """
+   Convert rows to a structured array (see dtype)
+
+   A TruncationError is raised if a string does not fit in its field.
+
+   Arguments:
+   rows -- list of tuples of the fields of dtype
+
+   """
+
+   rows = list(rows)
+   lines = numpy.array(rows, dtype=dtype)
+
+   # A truncated string fills its field, so only those are checked
+   for name, width in stringFields.items():
+      if len(lines) == 0:
+         break
+      index = dtype.names.index(name)
+      for i in numpy.flatnonzero(numpy.char.str_len(lines[name]) == width):
+         if len(rows[i][index]) > width:
+            raise TruncationError("%s longer than %d characters: %s"
+                                  % (name, width, rows[i][index]))
+
+   return lines
+
+def set_strings(lines, name, values):
+   """
+   Set a string field of a structured array of lines (see dtype)
+
+   A TruncationError is raised if a string does not fit in the field.
+
+   Arguments:
+   lines  -- the structured array
+   name   -- the field name
+   values -- a string, or an array of strings
+
+   """
+
+   width = stringFields[name]
+   values = numpy.asarray(values)
+   if values.dtype.kind == "U" and values.dtype.itemsize // 4 > width and values.size:
+      lengths = numpy.char.str_len(values)
+      if lengths.max() > width:
+         raise TruncationError("%s longer than %d characters: %s"
+                               % (name, width, values.ravel()[lengths.argmax()]))
+   lines[name] = values
+
+def from_array(array):
+   """
+   Convert a structured array (see dtype) to a list of line objects
+
+   Arguments:
+   array -- structured array of lines
+
+   """
+
+   lines = []
+   for row in array.tolist():
+      l = line()
+      l.species = row[0]
+      l.frequency = row[1]
+      l.err_frequency = row[2]
+      l.einstein_coefficient = row[3]
+      l.upper_level.energy = row[4]
+      l.upper_level.statistical_weight = row[5]
+      l.upper_level.quantum_numbers = row[6]
+      l.lower_level.energy = row[7]
+      l.lower_level.statistical_weight = row[8]
+      l.lower_level.quantum_numbers = row[9]
+      l.origin = row[10]
+      l.dbsource = row[11]
+      lines.append(l)
+
+   return lines
+
 if __name__ == "__main__":
    l = line()
    print(l)
@@ -5,14 +5,22 @@ This file is part of Weeds.
 
 """
 
+import os
 import sys
 import copy
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import numpy as np
 from scipy.interpolate import interp1d
+from scipy.special import erf
 
 from .consts import *
 from . import cdms
+from . import cache
+from . import db
 from .db import blankPartfunc
 from .sicparse import OptionParser
 
@@ -154,6 +162,86 @@ def find_freq_step(components, fmin):
     return model_freq_step
 
 
+# Half width of the fine channel windows of the adaptive grid, in line
+# FWHM, and ratio between its coarse channels and the channels of the
+# uniform grid
+adaptive_width = 4.
+adaptive_coarse_factor = 100
+
+
+def adaptive_grid(components, fetched, fmin, fmax, freq_step=None,
+                  width=None, coarse_factor=None):
+    """
+    Build a non-uniform frequency grid adapted to a set of lines
+
+    Within width FWHM (default adaptive_width) of the center of each
+    line, channels are a tenth of the line FWHM, as in find_freq_step.
+    Elsewhere, channels are coarse_factor (default
+    adaptive_coarse_factor) times freq_step. The number of channels
+    therefore scales with the number of lines instead of the
+    bandwidth.
+
+    Arguments:
+    components    -- list of components
+    fetched       -- lines of each component, as returned by prefetch
+    fmin          -- the minimum frequency in MHz
+    fmax          -- the maximum frequency in MHz
+    freq_step     -- the step of the uniform grid (default from
+                     find_freq_step)
+    width         -- half width of the fine channel windows, in FWHM
+    coarse_factor -- ratio between coarse channels and freq_step
+
+    Returns the frequency grid, in MHz.
+
+    """
+
+    if freq_step is None:
+        freq_step = find_freq_step(components, fmin)
+    if width is None:
+        width = adaptive_width
+    if coarse_factor is None:
+        coarse_factor = adaptive_coarse_factor
+
+    coarse = np.arange(fmin, fmax, freq_step * coarse_factor)
+
+    # Fine windows of all the lines
+    lo = []
+    hi = []
+    step = []
+    for c in components:
+        lines = fetched[(c.species, c.origin)]
+        if lines is None or len(lines) == 0:
+            continue
+        frequency = line_columns(lines)[0]
+        center = frequency - c.v_off * 1e3 / speed_of_light * frequency  # MHz
+        fwhm = abs(c.delta_v) * 1e3 / speed_of_light * frequency  # MHz
+        lo.append(center - width * fwhm)
+        hi.append(center + width * fwhm)
+        step.append(fwhm / 10.)
+    if len(lo) == 0:
+        return coarse
+    lo = np.concatenate(lo)
+    hi = np.concatenate(hi)
+    step = np.concatenate(step)
+
+    # Overlapping windows are merged, and sampled with the finest step
+    # of their lines, so that blended lines do not add up channels.
+    order = np.argsort(lo, kind='stable')
+    lo, hi, step = lo[order], hi[order], step[order]
+    start = np.ones(len(lo), dtype=bool)
+    start[1:] = lo[1:] > np.maximum.accumulate(hi)[:-1]
+    glo = lo[start]
+    ghi = np.maximum.reduceat(hi, np.flatnonzero(start))
+    gstep = np.minimum.reduceat(step, np.flatnonzero(start))
+    count = np.ceil((ghi - glo) / gstep).astype(int) + 1
+    first = np.cumsum(count) - count
+    index = np.arange(count.sum()) - np.repeat(first, count)
+    fine = np.repeat(glo, count) + index * np.repeat(gstep, count)
+    fine = fine[(fine >= fmin) & (fine < fmax)]
+
+    return np.unique(np.concatenate((coarse, fine)))
+
+
 def getLines(cdmsobject, fmin, fmax, species, origin, energy=-1, einstein=-1):
 
     lines = cdmsobject.search(fmin, fmax, species=species, origin=origin)
@@ -161,24 +249,762 @@ def getLines(cdmsobject, fmin, fmax, species, origin, energy=-1, einstein=-1):
     return lines
 
 
-def getPartitionfuc(cdmsobject, species, Tex):
-    """get partition function, given species name and excitation temperature"""
-    t_dummy, part_dummy = cdmsobject.part_function(species, 'cdms', 'cdms')
-    f = interp1d(np.log(t_dummy), np.log(part_dummy))
-    return np.exp(f(np.log(Tex)))
+class LRUCache:
+    """
+    Least recently used cache
+
+    Values are computed on demand and the least recently used ones are
+    dropped once more than maxsize are stored.
+
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+        Returns the value for a given key
+
+        Arguments:
+        key     -- hashable key
+        compute -- function called without argument to compute the
+                   value if it is not cached
+
+        """
+
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+                self.hits += 1
+                return self.values[key]
+
+        value = compute()
+
+        with self.lock:
+            self.misses += 1
+            self.values[key] = value
+            while len(self.values) > self.maxsize:
+                self.values.popitem(last=False)
+
+        return value
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.values
+
+    def clear(self):
+        """
+        Remove all values
+
+        """
+
+        with self.lock:
+            self.values.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+def partition_interpolator(temperature, partfunc):
+    """
+    Returns a function interpolating the partition function
+
+    The interpolation is linear in log-log space. The function accepts
+    a temperature or an array of temperatures.
+
+    Arguments:
+    temperature -- temperatures, in K
+    partfunc    -- partition function at these temperatures
+
+    """
+
+    f = interp1d(np.log(temperature), np.log(partfunc))
+
+    def interpolator(Tex):
+        return np.exp(f(np.log(Tex)))
+
+    return interpolator
+
+
+# Partition function interpolators, indexed by (database key, species,
+# origin, dbsource, version of the CDMS table), see
+# getPartitionInterpolator, or by the tables they are built from (see
+# derivelineflux)
+partition_functions = LRUCache(maxsize=256)
+
+
+def getPartitionfuc(cdmsobject, species, Tex, origin='cdms', dbsource='cdms'):
+    """get partition function, given species name and excitation temperature
+
+    Tex may be an array, in which case an array is returned. The
+    interpolator is built on the first call for a given database and
+    species, and then taken from the partition_functions cache (see
+    getPartitionInterpolator).
+    """
+    return getPartitionInterpolator(cdmsobject, species, origin, dbsource)(Tex)
+
+
+def getPartitionInterpolator(cdmsobject, species, origin='cdms', dbsource='cdms'):
+    """get the partition function interpolator of a species
+
+    See getPartitionfuc. Interpolators are indexed by the database (see
+    database_key), so that they are shared by the instances opened on
+    the same database, e.g. by successive modsource calls, and by
+    (species, origin, dbsource). They are built again when the CDMS
+    partition function table is reloaded (see cdms.load_partfunc).
+    """
+    def compute():
+        t_dummy, part_dummy = cdmsobject.part_function(species, origin, dbsource)
+        return partition_interpolator(t_dummy, part_dummy)
+    return partition_functions.get((database_key(cdmsobject), species, origin,
+                                    dbsource, cdms.partfuncVersion), compute)
+
+
+def line_source(lines):
+    """
+    Returns the origin and database source of a list of lines
+
+    They are those of the first line, and are used to get the
+    partition function of the species from the same database.
+
+    Arguments:
+    lines -- list of line objects, or structured array of lines (see
+             line.dtype)
+
+    """
+
+    if isinstance(lines, np.ndarray):
+        return str(lines['origin'][0]), str(lines['dbsource'][0])
+    return lines[0].origin, lines[0].dbsource or lines[0].prev
+
+
+# Maximum number of concurrent requests made by prefetch
+prefetch_workers = 8
+
+
+def prefetch(cdmsobject, components, fmin, fmax, max_workers=None,
+             windows=None):
+    """
+    Fetch the lines and partition functions of all components
+
+    The requests to the database are made concurrently, by a pool of
+    at most max_workers threads (default prefetch_workers), so that the
+    time spent waiting for the network is that of the slowest species
+    instead of the sum over all species. Partition functions are
+    stored in the partition_functions cache (see
+    getPartitionInterpolator). Errors on partition functions are
+    ignored here, so that they are raised when the component is
+    computed.
+
+    Arguments:
+    cdmsobject  -- the line database
+    components  -- list of components
+    fmin        -- the minimum frequency in MHz
+    fmax        -- the maximum frequency in MHz
+    max_workers -- maximum number of concurrent requests
+    windows     -- list of (fmin, fmax) frequency windows, in MHz, to
+                   search instead of fmin and fmax. The lines of all
+                   windows are fetched at once (see db.Db.search_windows).
+
+    Returns a dictionary of lines indexed by (species, origin), or of
+    lists of lines per window if windows is given.
+
+    """
+
+    if max_workers is None:
+        max_workers = prefetch_workers
+
+    keys = list(OrderedDict.fromkeys((c.species, c.origin)
+                                     for c in components))
+
+    def fetch(key):
+        species, origin = key
+        if windows is None:
+            lines = getLines(cdmsobject, fmin, fmax, species, origin, -1, -1)
+            found = [lines]
+        elif hasattr(cdmsobject, 'search_windows'):
+            lines = cdmsobject.search_windows(windows, species=species,
+                                              origin=origin)
+            found = lines
+        else:
+            lines = [getLines(cdmsobject, wmin, wmax, species, origin, -1, -1)
+                     for wmin, wmax in windows]
+            found = lines
+        found = [l for l in found if l is not None and len(l) > 0]
+        if len(found) > 0:
+            try:
+                getPartitionInterpolator(cdmsobject, species,
+                                         *line_source(found[0]))
+            except Exception:
+                pass
+        return lines
+
+    if len(keys) == 0:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(keys)))) as pool:
+        return dict(zip(keys, pool.map(fetch, keys)))
+
+
+# Maximum number of (line, channel) elements evaluated at once by the
+# opacity kernel, i.e. about 32 MB per float64 temporary.
+opacity_block_size = 2**22
+
+
+def line_columns(lines):
+    """
+    Convert a list of lines to NumPy columns
+
+    Arguments:
+    lines -- list of line objects, or structured array of lines (see
+             line.dtype)
+
+    Returns the frequency (MHz), Einstein coefficient (s-1), upper
+    level statistical weight and upper level energy (K) arrays.
+
+    """
+
+    if isinstance(lines, np.ndarray):
+        return (lines['frequency'].astype(float),
+                lines['einstein_coefficient'].astype(float),
+                lines['upper_level_statistical_weight'].astype(float),
+                lines['upper_level_energy'].astype(float))
+
+    frequency = np.array([l.frequency for l in lines], dtype=float)
+    einstein = np.array([l.einstein_coefficient for l in lines], dtype=float)
+    gup = np.array([l.upper_level.statistical_weight for l in lines],
+                   dtype=float)
+    eup = np.array([l.upper_level.energy for l in lines], dtype=float)
+
+    return frequency, einstein, gup, eup
+
+
+def channel_edges(edges):
+    """
+    Returns the lower and upper edges of a set of channels
+
+    Arguments:
+    edges -- the channel edges, in MHz: either an array of n + 1 edges
+             of n contiguous channels, an array of (lower, upper) edges
+             with shape (n, 2), or a list of such arrays (e.g. one per
+             spectral window). Channels must be in increasing frequency
+             order and must not overlap.
+
+    Returns the lower and upper edges of each channel.
+
+    """
+
+    if isinstance(edges, (list, tuple)) and len(edges) > 0 \
+            and np.ndim(edges[0]) > 0:
+        bounds = [channel_edges(e) for e in edges]
+        lo = np.concatenate([b[0] for b in bounds])
+        hi = np.concatenate([b[1] for b in bounds])
+    else:
+        edges = np.asarray(edges, dtype=float)
+        if edges.ndim == 1:
+            lo, hi = edges[:-1], edges[1:]
+        elif edges.ndim == 2 and edges.shape[1] == 2:
+            lo, hi = edges[:, 0], edges[:, 1]
+        else:
+            raise ValueError("Channel edges must have shape (n + 1,) or (n, 2)")
+
+    if np.any(hi <= lo) or np.any(lo[1:] < hi[:-1]):
+        raise ValueError("Channels must be in increasing frequency order"
+                         " and must not overlap")
+
+    return lo, hi
+
+
+# Margin around the channels given by their edges within which lines
+# are fetched, in line FWHM (see edges_range)
+edges_margin = 5.
+
+
+def edges_range(edges, delta_v, v_off, margin=None):
+    """
+    Returns the frequency range of the lines that contribute to a set
+    of channels
+
+    Arguments:
+    edges   -- lower and upper edges of the channels, in MHz (see
+               channel_edges)
+    delta_v -- line width (FWHM), in km/s, or an array of line widths
+    v_off   -- velocity offset, in km/s, or an array of offsets
+    margin  -- the margin around the channels, in line FWHM (default
+               edges_margin)
+
+    Returns the minimum and maximum frequencies, in MHz.
+
+    """
+
+    if margin is None:
+        margin = edges_margin
+
+    lower, upper = edges
+    velocity = margin * np.max(np.abs(delta_v)) + np.max(np.abs(v_off))  # km/s
+    shift = velocity * 1e3 / speed_of_light
+
+    return np.min(lower) * (1 - shift), np.max(upper) * (1 + shift)
+
+
+def line_opacity(freq, columns, Ntot, Tex, v_off, delta_v, partitionfunc,
+                 cutoff=None, block_size=None, edges=None):
+    """
+    Compute the total opacity of a set of lines
+
+    The lines are evaluated together, by blocks of lines so that at
+    most block_size (line, channel) elements are held in memory at
+    once. If cutoff is given, the line profiles are truncated at
+    cutoff sigma from the line center, and each line is only evaluated
+    over the channels within that window (found with a binary search
+    on the frequency grid).
+
+    If edges is given, the opacity is averaged over each channel
+    instead of being taken at the channel frequency: the Gaussian
+    profile is integrated analytically between the channel edges, so
+    that channels do not need to be narrower than the lines.
+
+    Arguments:
+    freq          -- frequency grid, in MHz (the channel centers if
+                     edges is given)
+    columns       -- line columns, as returned by line_columns
+    Ntot          -- column density, in cm-2
+    Tex           -- excitation temperature, in K
+    v_off         -- velocity offset, in km/s
+    delta_v       -- line width (FWHM), in km/s
+    partitionfunc -- partition function at Tex
+    cutoff        -- profile truncation, in sigma (default None, i.e.
+                     no truncation)
+    block_size    -- maximum block size (default opacity_block_size)
+    edges         -- lower and upper edges of the channels, in MHz (see
+                     channel_edges)
+
+    Returns the total opacity over the frequency grid and the opacity
+    at the center of each line.
+
+    """
+
+    if block_size is None:
+        block_size = opacity_block_size
+
+    frequency, einstein, gup, eup = columns
+    nline = len(frequency)
+
+    tau_tot = np.zeros(len(freq))
+    tau0 = np.zeros(nline)
+    if nline == 0 or len(freq) == 0:
+        return tau_tot, tau0
+
+    # Line profile parameters and line strength, i.e. everything in
+    # the line opacity that depends on the line but not on the channel
+    freq_off = -v_off * 1e3 / speed_of_light * frequency  # MHz
+    sigma = frequency / (speed_of_light * np.sqrt(8 * np.log(2))) \
+        * delta_v * 1e3 * 1e6  # Hz
+    strength = einstein * Ntot * 1e4 * gup * np.exp(-eup / Tex) \
+        / partitionfunc * (np.exp(planck_constant * frequency * 1e6
+                                  / (Tex * boltzmann_constant)) - 1) \
+        / (sigma * np.sqrt(2 * np.pi))
+
+    # Channel dependent factor
+    scale = speed_of_light**2 / (8 * np.pi * (freq * 1e6)**2)
+
+    if edges is None:
+        lower = upper = freq
+    else:
+        lower, upper = edges
+
+    def profile(s, chan):
+        # Line profile of lines s over channels chan, normalized to one
+        # at the line center
+        if edges is None:
+            return np.exp(-((freq[chan] - frequency[s, None] - freq_off[s, None])
+                            * 1e6)**2 / (2 * sigma[s, None]**2))
+        # Mean of the profile over the channel
+        center = frequency[s, None] + freq_off[s, None]
+        width = np.sqrt(2) * sigma[s, None]
+        return (erf((upper[chan] - center) * 1e6 / width)
+                - erf((lower[chan] - center) * 1e6 / width)) \
+            * np.sqrt(np.pi) / 2 * width / ((upper[chan] - lower[chan]) * 1e6)
+
+    if cutoff is None:
+        step = max(1, block_size // len(freq))
+        for start in range(0, nline, step):
+            s = slice(start, start + step)
+            tau = scale * strength[s, None] * profile(s, slice(None))
+            tau0[s] = tau.max(axis=1)
+            tau_tot += tau.sum(axis=0)
+        return tau_tot, tau0
+
+    # Windowed evaluation: each line only contributes to the channels
+    # within cutoff sigma of its center. Lines are taken in frequency
+    # order, so that the channels touched by a block of lines are
+    # contiguous.
+    center = frequency + freq_off
+    half_width = cutoff * sigma * 1e-6  # MHz
+    lo = np.searchsorted(upper, center - half_width, side='left')
+    hi = np.searchsorted(lower, center + half_width, side='right')
+    order = np.argsort(center, kind='stable')
+    width = max(1, np.max(hi - lo))
+    offset = np.arange(width)
+
+    step = max(1, block_size // width)
+    for start in range(0, nline, step):
+        s = order[start:start + step]
+        chan = lo[s, None] + offset
+        inside = chan < hi[s, None]
+        chan = np.minimum(chan, len(freq) - 1)
+        tau = scale[chan] * strength[s, None] * profile(s, chan)
+        tau[~inside] = 0.
+        tau0[s] = tau.max(axis=1)
+        first = lo[s].min()
+        last = max(first, hi[s].max())
+        tau_tot[first:last] += np.bincount(chan[inside] - first,
+                                           weights=tau[inside],
+                                           minlength=last - first)
+
+    return tau_tot, tau0
+
+
+def grid_key(freq):
+    """
+    Returns a hashable key identifying a frequency grid
+
+    Arguments:
+    freq -- frequency grid, in MHz
+
+    """
+
+    freq = np.ascontiguousarray(freq, dtype=float)
+    if len(freq) == 0:
+        return (0,)
+
+    return (len(freq), freq[0], freq[-1], zlib.crc32(freq))
+
+
+def lines_key(columns):
+    """
+    Returns a hashable key identifying a set of lines
+
+    Arguments:
+    columns -- line columns, as returned by line_columns
+
+    """
+
+    key = [len(columns[0])]
+    for column in columns:
+        key.append(zlib.crc32(np.ascontiguousarray(column, dtype=float)))
+
+    return tuple(key)
+
+
+def database_key(cdmsobject):
+    """
+    Returns a hashable key identifying a line database
+
+    The key is the same for two instances opened on the same database
+    (e.g. the online CDMS, or the same cache or catalog file), so that
+    it can be used across modsource calls.
+
+    Arguments:
+    cdmsobject -- the line database
+
+    """
+
+    if hasattr(cdmsobject, 'databases'):
+        # Federated database
+        return (type(cdmsobject).__name__, cdmsobject.name,
+                tuple(database_key(d) for d in cdmsobject.databases))
+    if isinstance(cdmsobject, cache.ReadThrough):
+        return (type(cdmsobject).__name__, database_key(cdmsobject.database),
+                os.path.abspath(cdmsobject.cache.db_file))
+
+    # Partition functions given to the database (see catfile.Catfile)
+    partfunc = getattr(cdmsobject, 'partfunc', None)
+    if partfunc is not None:
+        partfunc = tuple(np.concatenate([np.ravel(p) for p in partfunc]).tolist())
+
+    return (type(cdmsobject).__name__, cdmsobject.name,
+            getattr(cdmsobject, 'url', ''),
+            getattr(cdmsobject, 'cache_file', ''), partfunc)
+
+
+class OpacityTemplates(LRUCache):
+    """
+    Cache of unit column density opacity templates
+
+    The line opacity is proportional to the column density, while the
+    other parameters (excitation temperature, line width, velocity
+    offset and frequency grid) enter through the partition function,
+    the Boltzmann and stimulated emission factors and the line profile.
+    A template computed once for Ntot = 1 cm-2 can therefore be reused
+    for any column density with a scalar multiply. The least recently
+    used templates are dropped once more than maxsize are stored.
+
+    """
+
+
+def opacity_worker(arguments):
+    """
+    Returns line_opacity(*arguments), for process pools
+
+    """
+
+    return line_opacity(*arguments)
+
+
+def component_opacities(tasks, templates=None, parallel=None, workers=None):
+    """
+    Compute the opacities of a set of components
+
+    Arguments:
+    tasks     -- list of (key, arguments) tuples, one per component, where
+                 arguments is a function returning the arguments of
+                 line_opacity and key the key of the opacity in templates
+                 (or None). Tasks may be None for components without lines.
+    templates -- an OpacityTemplates instance (default None)
+    parallel  -- None to compute the opacities serially, 'thread' or
+                 'process' to compute them in a pool of threads or
+                 processes
+    workers   -- maximum number of threads or processes (default the
+                 number of CPUs)
+
+    Returns the list of (tau_tot, tau0) opacities of the components, as
+    returned by line_opacity (None for tasks that are None). The results
+    are the same whether they are computed in parallel or not.
+
+    """
+
+    if parallel not in (None, 'thread', 'process'):
+        raise ValueError("Unknown parallel mode %s" % parallel)
+
+    # Only the opacities that are not in templates are computed, once
+    # per key
+    todo = []
+    keys = set()
+    for j, task in enumerate(tasks):
+        if task is None:
+            continue
+        key = task[0]
+        if key is None:
+            todo.append(j)
+        elif key not in keys and key not in templates:
+            keys.add(key)
+            todo.append(j)
+    arguments = dict((j, tasks[j][1]()) for j in todo)
+
+    computed = {}
+    if parallel is None or len(todo) < 2:
+        for j in todo:
+            computed[j] = line_opacity(*arguments[j])
+    else:
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if parallel == 'thread':
+            executor = ThreadPoolExecutor
+        else:
+            executor = ProcessPoolExecutor
+        with executor(max_workers=max(1, min(workers, len(todo)))) as pool:
+            results = pool.map(opacity_worker, [arguments[j] for j in todo])
+            computed = dict(zip(todo, results))
+
+    opacities = []
+    for j, task in enumerate(tasks):
+        if task is None:
+            opacities.append(None)
+        elif task[0] is None:
+            opacities.append(computed[j])
+        else:
+            key, args = task
+            if j in computed:
+                compute = lambda j=j: computed[j]
+            else:
+                compute = lambda args=args: line_opacity(*args())
+            opacities.append(templates.get(key, compute))
+
+    return opacities
+
+
+# Caches opened by line_database, indexed by file name. They are kept
+# between calls, so that their connections are reused instead of being
+# opened again on every call.
+line_caches = {}
+line_caches_lock = threading.Lock()
+
+
+def line_database(database=None, cache_file=None):
+    """
+    Returns the line database used by modsource
+
+    Arguments:
+    database   -- a db.Db instance (default the online CDMS)
+    cache_file -- the name of a local SQLite cache, read through and
+                  created if needed (see cache.ReadThrough). A single
+                  cache.Cache instance is used for each file.
+
+    """
+
+    # a cdms object, unless another database is given
+
+    if database is not None:
+        cdmsobject = database
+    else:
+        cdmsobject = cdms.Cdms(url="https://cdms.astro.uni-koeln.de/cgi-bin/cdmssearch",
+                               cache_file="~/.gag/scratch/cdms.db", protocol="cdms_post",
+                               online=True, name="cdms")
+
+    if cache_file is not None:
+        cache_file = os.path.abspath(os.path.expanduser(cache_file))
+        with line_caches_lock:
+            linecache = line_caches.get(cache_file)
+            if linecache is None:
+                linecache = cache.Cache(cache_file)
+                line_caches[cache_file] = linecache
+            if not os.path.isfile(linecache.db_file):
+                # The connections may be to a file that has been removed
+                linecache.close()
+                linecache.create(db.dbVersion)
+        cdmsobject = cache.ReadThrough(cdmsobject, linecache)
+
+    return cdmsobject
 
 
 def modsource(components, fmin, fmax, freq_step=None,
               theta_tel=None, background=2.7,
-              verbose=False, extra_result=False):
+              verbose=False, extra_result=False, cutoff=None,
+              block_size=None, templates=None, cache_file=None,
+              max_workers=None, database=None, grid='uniform',
+              freq_out=None, edges=None, windows=None, parallel=None,
+              workers=None):
     """
     Model the emission of a given source at the ETL
 
+    The opacity of all the lines of a species is computed at once by
+    line_opacity, by blocks of at most block_size (line, channel)
+    elements (default opacity_block_size). If cutoff is given (e.g.
+    8), line profiles are truncated at cutoff sigma from the line
+    center and each line is only evaluated within that window, so that
+    the cost scales with the profile width instead of the bandwidth.
+
+    If templates (an OpacityTemplates instance) is given, the opacity
+    of each species is computed for a unit column density and cached,
+    so that subsequent calls that only change Ntot are a scalar
+    multiply.
+
+    Lines and partition functions are searched in database (a db.Db
+    instance, e.g. a db.Local or catfile.Catfile instance), or by
+    default in the online CDMS. If cache_file is given, they are read
+    through a local SQLite cache (see cache.ReadThrough), which is
+    created if needed: only the frequency ranges and species that are
+    not in the cache yet are fetched from the database.
+
+    The lines and partition functions of all components are fetched
+    concurrently before the emission is computed, with at most
+    max_workers concurrent requests (see prefetch).
+
+    The emission is computed on a uniform grid of freq_step channels
+    (default from find_freq_step) if grid is 'uniform', or on a grid
+    with fine channels around the lines only if grid is 'adaptive'
+    (see adaptive_grid). If freq_out is given, the results are
+    linearly interpolated on that frequency grid.
+
+    If edges is given (see channel_edges), the emission is instead
+    computed directly on these channels, e.g. those of an observed
+    spectrum, with the line opacities averaged over each channel (see
+    line_opacity). The returned frequencies are the channel centers.
+    Note that the opacity, not the emission, is averaged, which is
+    exact for optically thin lines only. Lines are then fetched over
+    the channels, with a margin of edges_margin line widths, whatever
+    fmin and fmax (see edges_range).
+
+    If windows (a list of (fmin, fmax) frequency windows, in MHz) is
+    given, fmin and fmax are ignored, and the emission is computed on
+    each window. The lines of each species are fetched once for all
+    windows, and each window only gets its own lines. The result is a
+    list with the result of each window. freq_out and edges, if
+    given, must then be lists with one entry per window.
+
+    If parallel is 'thread' or 'process', the opacities of the
+    components are computed in a pool of at most workers threads or
+    processes (default the number of CPUs), see component_opacities.
+    The results are the same as when they are computed serially.
+
+    """
+    if grid not in ('uniform', 'adaptive'):
+        raise ValueError("Unknown grid %s" % grid)
+
+    cdmsobject = line_database(database, cache_file)
+
+    if windows is not None:
+        if freq_out is not None and len(freq_out) != len(windows):
+            raise ValueError("freq_out must have one entry per window")
+        if edges is not None and len(edges) != len(windows):
+            raise ValueError("edges must have one entry per window")
+        fetch_windows = windows
+        if edges is not None:
+            fetch_windows = [edges_range(channel_edges(e),
+                                         [c.delta_v for c in components],
+                                         [c.v_off for c in components])
+                             for e in edges]
+        fetched = prefetch(cdmsobject, components, fmin, fmax, max_workers,
+                           fetch_windows)
+        return [emission(components, cdmsobject,
+                         dict((key, lines[j]) for key, lines in fetched.items()),
+                         wmin, wmax, freq_step, theta_tel, background,
+                         extra_result, cutoff, block_size, templates, grid,
+                         None if freq_out is None else freq_out[j],
+                         None if edges is None else edges[j], parallel,
+                         workers)
+                for j, (wmin, wmax) in enumerate(windows)]
+
+    fetch_min, fetch_max = fmin, fmax
+    if edges is not None:
+        fetch_min, fetch_max = edges_range(channel_edges(edges),
+                                           [c.delta_v for c in components],
+                                           [c.v_off for c in components])
+    fetched = prefetch(cdmsobject, components, fetch_min, fetch_max,
+                       max_workers)
+
+    return emission(components, cdmsobject, fetched, fmin, fmax, freq_step,
+                    theta_tel, background, extra_result, cutoff, block_size,
+                    templates, grid, freq_out, edges, parallel, workers)
+
+
+def emission(components, cdmsobject, fetched, fmin, fmax, freq_step=None,
+             theta_tel=None, background=2.7, extra_result=False,
+             cutoff=None, block_size=None, templates=None, grid='uniform',
+             freq_out=None, edges=None, parallel=None, workers=None):
+    """
+    Model the emission of a given source on a frequency window
+
+    This is the computation made by modsource, once the lines have
+    been fetched.
+
+    Arguments:
+    components -- list of components
+    cdmsobject -- the line database, for partition functions
+    fetched    -- lines of each component, as returned by prefetch
+    fmin       -- the minimum frequency in MHz
+    fmax       -- the maximum frequency in MHz
+
+    Other arguments are the same as for modsource.
+
     """
     if freq_step == None:
         freq_step = find_freq_step(components, fmin)
 
-    freq = np.arange(fmin, fmax, freq_step)
+    if edges is not None:
+        edges = channel_edges(edges)
+        freq = (edges[0] + edges[1]) / 2.
+        edges_key = (grid_key(edges[0]), grid_key(edges[1]))
+    elif grid == 'adaptive':
+        freq = adaptive_grid(components, fetched, fmin, fmax, freq_step)
+    else:
+        freq = np.arange(fmin, fmax, freq_step)
+    if edges is None:
+        edges_key = None
 
     # Compute the antenna temperature and opacity over the entire
     # frequency range.  See Maret et al. (2010, in prep.) for the
@@ -189,56 +1015,70 @@ def modsource(components, fmin, fmax, freq_step=None,
     intensity_grand_tot = np.zeros(len(freq))
 
     tb_species = np.zeros((len(freq), len(components)))
+    tau_tot = np.zeros(len(freq))
     keep_opacity_flag = False
     i = 0
 
-    # a cdms object
-
-    cdmsobject = cdms.Cdms(url="https://cdms.astro.uni-koeln.de/cgi-bin/cdmssearch",
-                           cache_file="~/.gag/scratch/cdms.db", protocol="cdms_post",
-                           online=True, name="cdms")
-
+    # Opacity of each component. The components are independent, so
+    # that their opacities may be computed in parallel (see
+    # component_opacities), while the radiative transfer below depends
+    # on the order of the components and is done serially.
+    tasks = []
     for c in components:
         # print 'computing for species %s' %(c.species)
 
-        lines = getLines(cdmsobject, fmin, fmax, c.species, c.origin, -1, -1)
+        lines = fetched[(c.species, c.origin)]
 
-        # Compute the total opacity for that species
-        tau_tot = np.zeros(len(freq))
-
-        if len(lines) == 0:
+        if lines is None or len(lines) == 0:
             print(("No %s lines found in the frequency range" % (c.species)))
-            i = i+1
+            tasks.append(None)
             continue
-        else:
-            print((" %i %s lines found in the frequency range" % (len(lines), c.species)))
+        print((" %i %s lines found in the frequency range" % (len(lines), c.species)))
 
-            partitionfunc = getPartitionfuc(cdmsobject, c.species, c.Tex)
+        columns = line_columns(lines)
 
-            for l in lines:
+        def arguments(c=c, lines=lines, columns=columns):
+            partitionfunc = getPartitionfuc(cdmsobject, c.species, c.Tex,
+                                            *line_source(lines))
+            return (freq, columns,
+                    c.Ntot if templates is None else 1., c.Tex, c.v_off,
+                    c.delta_v, partitionfunc, cutoff, block_size, edges)
+        key = None
+        if templates is not None:
+            key = (database_key(cdmsobject), c.species, c.origin,
+                   lines_key(columns), c.Tex, c.delta_v, c.v_off,
+                   grid_key(freq), cutoff, edges_key)
+        tasks.append((key, arguments))
 
-                # Line profile function
-                freq_off = -c.v_off * 1e3 / speed_of_light * l.frequency  # MHz
-                sigma = l.frequency / (speed_of_light * np.sqrt(8 * np.log(2))) \
-                    * c.delta_v * 1e3 * 1e6  # Hz
-                phi = 1 / (sigma * np.sqrt(2 * np.pi)) * np.exp(-((freq - l.frequency - freq_off)
-                                                                  * 1e6)**2 / (2 * sigma**2))
+    opacities = component_opacities(tasks, templates, parallel, workers)
 
-                # Line opacity
-                tau = speed_of_light**2 / (8 * np.pi * (freq * 1e6)**2) * l.einstein_coefficient \
-                    * c.Ntot * 1e4 * l.upper_level.statistical_weight \
-                    * np.exp(-l.upper_level.energy / c.Tex) \
-                    / partitionfunc * (np.exp(planck_constant * l.frequency * 1e6
-                                              / (c.Tex * boltzmann_constant))-1) * phi
+    for c, opacity in zip(components, opacities):
 
-                # Opacity at line center
-                l.tau0 = max(tau)
+        lines = fetched[(c.species, c.origin)]
 
-                tau_tot = tau_tot + tau
+        # Compute the total opacity for that species
+        tau_tot = np.zeros(len(freq))
 
-                if c.keep_opacity:
-                    tau_kept = tau_tot
-                    keep_opacity_flag = True
+        if opacity is None:
+            i = i+1
+            continue
+        else:
+            # Line opacities, all lines at once
+            if templates is None:
+                tau_tot, tau0 = opacity
+            else:
+                tau_unit, tau0_unit = opacity
+                tau_tot = c.Ntot * tau_unit
+                tau0 = c.Ntot * tau0_unit
+
+            # Opacity at line center (line objects only)
+            if not isinstance(lines, np.ndarray):
+                for l, t in zip(lines, tau0):
+                    l.tau0 = t
+
+            if c.keep_opacity:
+                tau_kept = tau_tot
+                keep_opacity_flag = True
 
         # Compute the antenna temperature for that species
 
@@ -259,8 +1099,232 @@ def modsource(components, fmin, fmax, freq_step=None,
         tb_species[:, i] = tb_tot
         i = i+1
 
+    if freq_out is not None:
+        freq_out = np.asarray(freq_out, dtype=float)
+        tb_grand_tot = np.interp(freq_out, freq, tb_grand_tot)
+        intensity_grand_tot = np.interp(freq_out, freq, intensity_grand_tot)
+        tau_tot = np.interp(freq_out, freq, tau_tot)
+        tb_species = np.array([np.interp(freq_out, freq, tb_species[:, j])
+                               for j in range(len(components))]).T.reshape(len(freq_out), len(components))
+        freq = freq_out
+
     # K. Zhang added this `extra_result` functionality.
     if extra_result == True:
         return freq, tb_grand_tot, tb_species, tau_tot, intensity_grand_tot
     else:
         return freq, tb_grand_tot, tb_species
+
+
+def grid_parameters(components, nmodels=None, **parameters):
+    """
+    Broadcast the component parameters of a grid of models
+
+    Arguments:
+    components -- list of components, giving the default parameters
+    nmodels    -- the number of models (default from the parameters)
+    parameters -- parameter arrays (e.g. Ntot=...), each a scalar, an
+                  array with one value per model (applied to all
+                  components), or an array of shape (nmodels,
+                  ncomponents)
+
+    Returns a dictionary of (nmodels, ncomponents) parameter arrays.
+
+    """
+
+    ncomp = len(components)
+    arrays = {}
+    for name, value in parameters.items():
+        if value is None:
+            value = [getattr(c, name) for c in components]
+            value = np.asarray(value, dtype=float).reshape(1, ncomp)
+        else:
+            value = np.asarray(value, dtype=float)
+            if value.ndim == 1:
+                value = value[:, None]
+            elif value.ndim > 2:
+                raise ValueError("%s must have at most two dimensions" % name)
+        arrays[name] = value
+
+    shape = np.broadcast_shapes((1, ncomp), *[a.shape for a in arrays.values()])
+    if nmodels is not None:
+        shape = np.broadcast_shapes(shape, (nmodels, ncomp))
+
+    return dict((name, np.broadcast_to(a, shape)) for name, a in arrays.items())
+
+
+def interp_rows(x, xp, fp):
+    """
+    Linear interpolation of each row of fp, as np.interp
+
+    Arguments:
+    x  -- the coordinates at which to interpolate
+    xp -- the increasing coordinates of the columns of fp
+    fp -- the values to interpolate, one row per set of values
+
+    """
+
+    x = np.clip(x, xp[0], xp[-1])
+    right = np.clip(np.searchsorted(xp, x, side='right'), 1, len(xp) - 1)
+    left = right - 1
+    dx = xp[right] - xp[left]
+    weight = np.where(dx > 0, (x - xp[left]) / np.where(dx > 0, dx, 1.), 0.)
+
+    return fp[:, left] * (1 - weight) + fp[:, right] * weight
+
+
+def modsource_grid(components, fmin, fmax, Ntot=None, Tex=None,
+                   delta_v=None, v_off=None, nmodels=None, freq_step=None,
+                   theta_tel=None, background=2.7, extra_result=False,
+                   cutoff=None, block_size=None, chunk_size=None,
+                   cache_file=None, max_workers=None, database=None,
+                   freq_out=None, edges=None, parallel=None, workers=None):
+    """
+    Model the emission of a grid of models of a given source at the ETL
+
+    This is equivalent to calling modsource for each set of component
+    parameters, but the lines and partition functions are fetched once,
+    and all models are computed on the same frequency grid: a uniform
+    grid with channels of freq_step (default from find_freq_step, with
+    the narrowest line width of all models), or the channels given by
+    edges (see modsource). Lines are then fetched over the channels,
+    with a margin of edges_margin times the widest line width of all
+    models (see edges_range).
+
+    The parameters Ntot, Tex, delta_v and v_off are broadcast to shape
+    (nmodels, ncomponents): each may be a scalar, an array with one
+    value per model (applied to all components), or an array with one
+    value per model and component. Parameters that are not given are
+    taken from the components. For example, a grid of Tex and Ntot for
+    a single component is given by Ntot=N.ravel(), Tex=T.ravel(), with
+    N, T = np.meshgrid(...).
+
+    The opacity of each component is computed once per distinct (Tex,
+    delta_v, v_off) for a unit column density (see OpacityTemplates),
+    and scaled by Ntot. The radiative transfer is computed for blocks
+    of chunk_size models at once (default such that a block holds
+    about opacity_block_size values). Models are ordered so that those
+    sharing an opacity are in the same block.
+
+    Arguments:
+    components -- list of components
+    fmin       -- the minimum frequency in MHz
+    fmax       -- the maximum frequency in MHz
+    nmodels    -- the number of models, if no parameter array gives it
+    chunk_size -- the number of models computed at once
+
+    Other arguments are the same as for modsource.
+
+    Returns the frequencies and the brightness temperature of each
+    model, as a (nmodels, nchannels) array, and also the intensity in
+    Jy if extra_result is True.
+
+    """
+
+    cdmsobject = line_database(database, cache_file)
+
+    parameters = grid_parameters(components, nmodels, Ntot=Ntot, Tex=Tex,
+                                 delta_v=delta_v, v_off=v_off)
+    nmodels = parameters['Ntot'].shape[0]
+
+    if freq_step is None:
+        narrowest = component()
+        narrowest.delta_v = np.min(np.abs(parameters['delta_v']))
+        freq_step = find_freq_step([narrowest], fmin)
+
+    if edges is not None:
+        edges = channel_edges(edges)
+        freq = (edges[0] + edges[1]) / 2.
+    else:
+        freq = np.arange(fmin, fmax, freq_step)
+    if freq_out is not None:
+        freq_out = np.asarray(freq_out, dtype=float)
+
+    fetch_min, fetch_max = fmin, fmax
+    if edges is not None:
+        fetch_min, fetch_max = edges_range(edges, parameters['delta_v'],
+                                           parameters['v_off'])
+    fetched = prefetch(cdmsobject, components, fetch_min, fetch_max,
+                       max_workers)
+
+    # Distinct opacities of each component, and the order of the
+    # models that groups those that share them
+    found = []
+    for j, c in enumerate(components):
+        lines = fetched[(c.species, c.origin)]
+        if lines is None or len(lines) == 0:
+            print(("No %s lines found in the frequency range" % (c.species)))
+            found.append(None)
+            continue
+        print((" %i %s lines found in the frequency range" % (len(lines), c.species)))
+        shapes = np.stack([parameters['Tex'][:, j], parameters['delta_v'][:, j],
+                           parameters['v_off'][:, j]], axis=1)
+        unique, inverse = np.unique(shapes, axis=0, return_inverse=True)
+        found.append((lines, line_columns(lines), unique, inverse.ravel()))
+    inverses = [f[3] for f in reversed(found) if f is not None]
+    order = np.lexsort(inverses) if inverses else np.arange(nmodels)
+
+    if chunk_size is None:
+        chunk_size = max(1, (block_size or opacity_block_size) // max(1, len(freq)))
+    templates = OpacityTemplates(maxsize=max(1, chunk_size * len(components)))
+
+    nout = len(freq) if freq_out is None else len(freq_out)
+    tb_grand_tot = np.zeros((nmodels, nout))
+    if extra_result:
+        intensity_grand_tot = np.zeros((nmodels, nout))
+
+    Jbg = J(background, freq)
+    for start in range(0, nmodels, chunk_size):
+        models = order[start:start + chunk_size]
+
+        tb = np.zeros((len(models), len(freq)))
+        intensity = np.zeros((len(models), len(freq)))
+        for j, c in enumerate(components):
+            if found[j] is None:
+                continue
+            lines, columns, unique, inverse = found[j]
+
+            # Unit opacities of the models of the block
+            needed, index = np.unique(inverse[models], return_inverse=True)
+            tasks = []
+            for u in needed:
+                def arguments(c=c, u=u, lines=lines, columns=columns, unique=unique):
+                    Tex_u, delta_v_u, v_off_u = unique[u]
+                    partitionfunc = getPartitionfuc(cdmsobject, c.species, Tex_u,
+                                                    *line_source(lines))
+                    return (freq, columns, 1., Tex_u, v_off_u, delta_v_u,
+                            partitionfunc, cutoff, block_size, edges)
+                tasks.append(((j, u), arguments))
+            opacities = component_opacities(tasks, templates, parallel, workers)
+            tau_unit = np.stack([tau for tau, tau0 in opacities])
+
+            # Radiative transfer of all the models of the block at once
+            Tex_m = parameters['Tex'][models, j][:, None]
+            tau_tot = parameters['Ntot'][models, j][:, None] * tau_unit[index.ravel()]
+            attenuation = np.exp(-tau_tot)
+            absorbed = 1 - attenuation
+            eta_source = c.theta**2 / (theta_tel**2 + c.theta**2)
+            tb_tot = eta_source * (J(Tex_m, freq) - Jbg) * absorbed
+
+            if not(c.absorption):
+                tb += tb_tot
+                if extra_result:
+                    solid_angle = np.pi*c.theta**2/(206265.*206265.)
+                    intensity += Planck_funct(Tex_m, freq) * absorbed * solid_angle
+            else:
+                tb = tb * attenuation + tb_tot
+
+        if freq_out is not None:
+            tb = interp_rows(freq_out, freq, tb)
+        tb_grand_tot[models] = tb
+        if extra_result:
+            if freq_out is not None:
+                intensity = interp_rows(freq_out, freq, intensity)
+            intensity_grand_tot[models] = intensity
+
+    if freq_out is not None:
+        freq = freq_out
+
+    if extra_result:
+        return freq, tb_grand_tot, intensity_grand_tot
+    else:
+        return freq, tb_grand_tot